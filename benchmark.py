@@ -0,0 +1,481 @@
+# Benchmark dan load test untuk final_app.py.
+#
+# Menjalankan server FTP lokal (pyftpdlib) berisi PNG sintetis peta_dpi/tabel_dpi dengan ukuran
+# realistis, menjalankan `final_app:app` di bawah uvicorn, lalu mensimulasikan N sesi websocket
+# yang memilih area dan tanggal, membuka modal, memuat gambar, dan mengunduh file.
+# Hasil: latensi p50/p95/p99 per aksi, throughput, memori per sesi, dan koneksi FTP yang dibuka.
+#
+#   pip install pyftpdlib websockets
+#   python benchmark.py --sessions 20 --duration 30 --json hasil.json
+#   python benchmark.py --sessions 20 --duration 30 --compare hasil.json
+#   python benchmark.py --sessions 20 --duration 30 --workers 4   # lewat serve.py
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+from datetime import date, timedelta
+
+try:
+    import websockets
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError as e:
+    sys.exit(f"Benchmark membutuhkan pyftpdlib dan websockets ({e}). Pasang dengan: pip install pyftpdlib websockets")
+
+AREAS = ["571", "572", "573", "711", "712", "713", "714", "715", "716", "717", "718"]
+KINDS = {"peta": (2000, 1400), "tabel": (1600, 1000)}
+FTP_USER = "bench"
+FTP_PASSWORD = "bench"
+OUTPUTS = ["peta_content", "tabel_content", "peta_download_count", "tabel_download_count"]
+
+
+def free_port(count=1):
+    while True:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        # Untuk beberapa worker: port berikutnya juga harus bebas
+        try:
+            for offset in range(1, count):
+                with socket.socket() as s:
+                    s.bind(("127.0.0.1", port + offset))
+            return port
+        except OSError:
+            continue
+
+
+# PNG RGB valid dengan ukuran file mendekati target: sebagian baris berisi noise (tidak
+# terkompresi), sisanya warna rata, sehingga dimensi tetap realistis untuk pembuatan varian
+def synthetic_png(width, height, target_bytes, seed):
+    rng = random.Random(seed)
+    noisy_rows = max(1, min(height, target_bytes // (width * 3)))
+    flat = b"\x00" + bytes([200, 220, 240]) * width
+    rows = []
+    for y in range(height):
+        rows.append(b"\x00" + rng.randbytes(width * 3) if y < noisy_rows else flat)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(b"".join(rows), 1)) + chunk(b"IEND", b"")
+
+
+def seed_files(directory, areas, dates, sizes_kb):
+    os.makedirs(directory, exist_ok=True)
+    # Satu isi per jenis; file lain berupa hardlink agar persiapan cepat dan hemat disk
+    templates = {}
+    for kind, (width, height) in KINDS.items():
+        path = os.path.join(directory, f".template_{kind}.png")
+        with open(path, "wb") as f:
+            f.write(synthetic_png(width, height, sizes_kb[kind] * 1024, seed=kind))
+        templates[kind] = path
+    count = 0
+    for area in areas:
+        for day in dates:
+            for kind, template in templates.items():
+                target = os.path.join(directory, f"{kind}_dpi_{area}_{day.strftime('%Y%m%d')}.png")
+                try:
+                    os.link(template, target)
+                except OSError:
+                    shutil.copyfile(template, target)
+                count += 1
+    for template in templates.values():
+        os.remove(template)
+    return count
+
+
+class CountingFtpHandler(FTPHandler):
+    connections = 0
+    lock = threading.Lock()
+
+    def on_connect(self):
+        with CountingFtpHandler.lock:
+            CountingFtpHandler.connections += 1
+
+
+def start_ftp_server(root, port, latency):
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(FTP_USER, FTP_PASSWORD, root, perm="elr")
+    handler = CountingFtpHandler
+    handler.authorizer = authorizer
+    if latency > 0:
+        # Simulasikan FTP yang jauh: jeda sebelum setiap perintah dijawab
+        original = FTPHandler.pre_process_command
+
+        def pre_process_command(self, line, cmd, arg):
+            time.sleep(latency)
+            return original(self, line, cmd, arg)
+
+        handler.pre_process_command = pre_process_command
+    server = ThreadedFTPServer(("127.0.0.1", port), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"handle_exit": False}, daemon=True)
+    thread.start()
+    return server
+
+
+# Dengan workers > 1 aplikasi dijalankan lewat serve.py; worker ke-i mendengarkan di port + i
+def start_app(port, env, workdir, workers=1):
+    if workers > 1:
+        command = [sys.executable, "serve.py", "--workers", str(workers), "--host", "127.0.0.1", "--port", str(port)]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "final_app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    log = open(os.path.join(workdir, "app.log"), "wb")
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=log, stderr=subprocess.STDOUT)
+    pending = [port + i for i in range(workers)]
+    deadline = time.time() + 30 * workers
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Aplikasi berhenti saat start, lihat {log.name}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{pending[0]}/cache", timeout=1).read()
+            pending.pop(0)
+            if not pending:
+                return process
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("Aplikasi tidak siap dalam 30 detik")
+
+
+# pid proses yang melayani setiap port (dibaca dari /cache), untuk mengukur memori semua worker
+def worker_pids(ports):
+    pids = []
+    for port in ports:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/cache", timeout=5) as response:
+            pids.append(json.load(response)["worker"]["pid"])
+    return pids
+
+
+def rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+# Jumlah semua sampel metrik name (label apa pun, misalnya worker="0") dari satu atau beberapa port
+def scrape_metric(ports, name):
+    total = None
+    for port in ports if isinstance(ports, (list, tuple)) else [ports]:
+        try:
+            text = urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5).read().decode()
+        except (urllib.error.URLError, OSError):
+            continue
+        for line in text.splitlines():
+            if line.startswith(name + " ") or line.startswith(name + "{"):
+                total = (total or 0) + float(line.rsplit(None, 1)[1])
+    return total
+
+
+def total_rss(pids):
+    values = [rss_bytes(pid) for pid in pids]
+    return None if None in values else sum(values)
+
+
+def http_get(url):
+    with urllib.request.urlopen(url, timeout=120) as response:
+        return len(response.read())
+
+
+class Stats:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+
+    def record(self, action, seconds):
+        self.samples.setdefault(action, []).append(seconds)
+
+    def error(self, action):
+        self.errors[action] = self.errors.get(action, 0) + 1
+
+    @staticmethod
+    def percentile(values, p):
+        values = sorted(values)
+        index = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+        return values[index]
+
+    def summary(self, duration):
+        report = {}
+        for action in sorted(set(self.samples) | set(self.errors)):
+            values = self.samples.get(action, [])
+            report[action] = {
+                "count": len(values),
+                "errors": self.errors.get(action, 0),
+                "throughput": round(len(values) / duration, 2),
+                "p50_ms": round(self.percentile(values, 50) * 1000, 1) if values else None,
+                "p95_ms": round(self.percentile(values, 95) * 1000, 1) if values else None,
+                "p99_ms": round(self.percentile(values, 99) * 1000, 1) if values else None,
+            }
+        return report
+
+
+class SimulatedSession:
+    def __init__(self, index, base_url, dates, stats, rng, think_time):
+        self.index = index
+        self.base_url = base_url
+        self.dates = dates
+        self.stats = stats
+        self.rng = rng
+        self.think_time = think_time
+        self.area = rng.choice(AREAS)
+        self.date = dates[-1]
+        self.values = {}
+        self.session_id = None
+        self.ws = None
+        self.clicks = {"expand_peta": 0, "expand_tabel": 0}
+
+    async def connect(self):
+        self.ws = await websockets.connect(self.base_url.replace("http", "ws", 1) + "/websocket/", max_size=None)
+        data = {"area": self.area}
+        data.update({f".clientdata_output_{name}_hidden": False for name in OUTPUTS})
+        await self.ws.send(json.dumps({"method": "init", "data": data}))
+        start = time.perf_counter()
+        await self.wait_for(lambda message: "config" in message)
+        self.session_id = self.last["config"]["sessionId"]
+        await self.wait_for(lambda message: self.has_images())
+        self.stats.record("initial_view", time.perf_counter() - start)
+
+    def has_images(self):
+        return all(name in self.values for name in ("peta_content", "tabel_content"))
+
+    async def wait_for(self, predicate, timeout=120):
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Pesan yang ditunggu tidak datang")
+            raw = await asyncio.wait_for(self.ws.recv(), remaining)
+            message = json.loads(raw)
+            self.last = message
+            self.values.update(message.get("values") or {})
+            if predicate(message):
+                return message
+
+    async def send_input(self, data):
+        await self.ws.send(json.dumps({"method": "update", "data": data}))
+
+    # Pilih tanggal atau area lain lalu tunggu sampai panel peta dan tabel dirender ulang
+    async def change_view(self):
+        self.values.clear()
+        if self.rng.random() < 0.3:
+            self.area = self.rng.choice([area for area in AREAS if area != self.area])
+            data = {"area": self.area}
+        else:
+            self.date = self.rng.choice([day for day in self.dates if day != self.date])
+            data = {"select_date": self.date.strftime("%Y-%m-%d")}
+        start = time.perf_counter()
+        await self.send_input(data)
+        await self.wait_for(lambda message: self.has_images())
+        self.stats.record("change_view", time.perf_counter() - start)
+        await self.load_images()
+
+    # Seperti browser: ambil gambar yang dirujuk HTML panel
+    async def load_images(self):
+        for name in ("peta_content", "tabel_content"):
+            html = self.values.get(name, {}).get("html", "")
+            marker = 'src="'
+            if marker not in html:
+                continue
+            src = html.split(marker, 1)[1].split('"', 1)[0].replace("&amp;", "&")
+            start = time.perf_counter()
+            try:
+                await asyncio.to_thread(http_get, f"{self.base_url}/{src}")
+                self.stats.record("image", time.perf_counter() - start)
+            except (urllib.error.URLError, OSError):
+                self.stats.error("image")
+
+    async def open_modal(self):
+        kind = self.rng.choice(["peta", "tabel"])
+        name = f"expand_{kind}"
+        self.clicks[name] += 1
+        start = time.perf_counter()
+        await self.send_input({f"{name}:shiny.action": self.clicks[name]})
+        await self.wait_for(lambda message: "modal" in message)
+        self.stats.record("modal", time.perf_counter() - start)
+
+    async def download(self):
+        kind = self.rng.choice(["peta", "tabel"])
+        url = f"{self.base_url}/session/{self.session_id}/download/unduh_{kind}?w="
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(http_get, url)
+            self.stats.record("download", time.perf_counter() - start)
+        except (urllib.error.URLError, OSError):
+            self.stats.error("download")
+
+    async def run(self, stop_at):
+        actions = [(self.change_view, 0.5), (self.open_modal, 0.25), (self.download, 0.25)]
+        while time.monotonic() < stop_at:
+            action = self.rng.choices([a for a, _ in actions], [w for _, w in actions])[0]
+            try:
+                await action()
+            except (TimeoutError, asyncio.TimeoutError, websockets.ConnectionClosed):
+                self.stats.error(action.__name__)
+                return
+            if self.think_time:
+                await asyncio.sleep(self.rng.uniform(0, self.think_time))
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+
+
+# Sesi dibagi bergiliran ke port worker, seperti reverse proxy dengan sticky session
+async def drive(args, dates, app_pids, app_ports):
+    stats = Stats()
+    rng = random.Random(args.seed)
+    sessions = [
+        SimulatedSession(i, f"http://127.0.0.1:{app_ports[i % len(app_ports)]}", dates, stats, random.Random(rng.random()), args.think_time)
+        for i in range(args.sessions)
+    ]
+    baseline_rss = total_rss(app_pids)
+    # Sesi dibuka bertahap agar lonjakan koneksi tidak mendominasi hasil
+    for session in sessions:
+        try:
+            await session.connect()
+        except (TimeoutError, asyncio.TimeoutError, OSError, websockets.ConnectionClosed):
+            stats.error("initial_view")
+        await asyncio.sleep(args.ramp / max(1, args.sessions))
+    connected_rss = total_rss(app_pids)
+    start = time.monotonic()
+    await asyncio.gather(*(session.run(start + args.duration) for session in sessions if session.session_id))
+    duration = time.monotonic() - start
+    peak_rss = total_rss(app_pids)
+    app_connections = scrape_metric(app_ports, "dpi_ftp_connections_opened")
+    for session in sessions:
+        await session.close()
+    per_session = None
+    if baseline_rss is not None and connected_rss is not None and args.sessions:
+        per_session = (connected_rss - baseline_rss) / args.sessions
+    return {
+        "config": {
+            "sessions": args.sessions, "workers": args.workers, "duration": args.duration, "areas": len(AREAS), "days": args.days,
+            "peta_kb": args.peta_kb, "tabel_kb": args.tabel_kb, "ftp_latency": args.ftp_latency, "seed": args.seed,
+        },
+        "actions": stats.summary(duration),
+        "throughput": round(sum(len(v) for action, v in stats.samples.items() if action != "initial_view") / duration, 2),
+        "memory": {
+            "baseline_mb": round(baseline_rss / 2**20, 1) if baseline_rss else None,
+            "connected_mb": round(connected_rss / 2**20, 1) if connected_rss else None,
+            "peak_mb": round(peak_rss / 2**20, 1) if peak_rss else None,
+            "per_session_kb": round(per_session / 1024, 1) if per_session is not None else None,
+        },
+        "ftp_connections": {"server": CountingFtpHandler.connections, "app_pool": app_connections},
+    }
+
+
+def print_report(report, baseline=None):
+    def delta(path, value):
+        if baseline is None or value is None:
+            return ""
+        old = baseline
+        for key in path:
+            old = (old or {}).get(key)
+        if not old:
+            return ""
+        return f" ({(value - old) / old * 100:+.0f}%)"
+
+    print(f"\n{'aksi':<14}{'jumlah':>8}{'error':>7}{'ops/s':>9}{'p50 ms':>16}{'p95 ms':>16}{'p99 ms':>16}")
+    for action, row in report["actions"].items():
+        cells = [
+            f"{row[p]}{delta(('actions', action, p), row[p])}" if row[p] is not None else "-"
+            for p in ("p50_ms", "p95_ms", "p99_ms")
+        ]
+        print(f"{action:<14}{row['count']:>8}{row['errors']:>7}{row['throughput']:>9}{cells[0]:>16}{cells[1]:>16}{cells[2]:>16}")
+    print(f"\nThroughput total: {report['throughput']} aksi/detik{delta(('throughput',), report['throughput'])}")
+    memory = report["memory"]
+    print(f"Memori aplikasi: awal {memory['baseline_mb']} MB, setelah sesi terhubung {memory['connected_mb']} MB, akhir {memory['peak_mb']} MB")
+    print(f"Memori per sesi: {memory['per_session_kb']} KB{delta(('memory', 'per_session_kb'), memory['per_session_kb'])}")
+    ftp = report["ftp_connections"]
+    print(f"Koneksi FTP dibuka: {ftp['server']} (tercatat di pool aplikasi: {ftp['app_pool']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark final_app.py dengan server FTP lokal dan sesi websocket simulasi")
+    parser.add_argument("--sessions", type=int, default=20, help="jumlah sesi websocket bersamaan")
+    parser.add_argument("--duration", type=float, default=30, help="lama pengukuran (detik) setelah semua sesi terhubung")
+    parser.add_argument("--ramp", type=float, default=5, help="waktu (detik) untuk membuka semua sesi")
+    parser.add_argument("--think-time", type=float, default=0.5, help="jeda acak maksimum (detik) antar aksi per sesi")
+    parser.add_argument("--days", type=int, default=7, help="jumlah tanggal (sampai hari ini) yang tersedia di FTP")
+    parser.add_argument("--peta-kb", type=int, default=600, help="ukuran file peta sintetis (KB)")
+    parser.add_argument("--tabel-kb", type=int, default=200, help="ukuran file tabel sintetis (KB)")
+    parser.add_argument("--ftp-latency", type=float, default=0.0, help="jeda (detik) per perintah FTP untuk meniru server jauh")
+    parser.add_argument("--seed", type=int, default=1, help="seed acak agar skenario dapat diulang")
+    parser.add_argument("--workers", type=int, default=1, help="jumlah worker; lebih dari 1 dijalankan lewat serve.py")
+    parser.add_argument("--env", action="append", default=[], metavar="NAMA=NILAI", help="environment tambahan untuk aplikasi (bisa diulang)")
+    parser.add_argument("--json", help="simpan hasil ke file JSON (sebagai baseline)")
+    parser.add_argument("--compare", help="bandingkan dengan hasil JSON sebelumnya")
+    parser.add_argument("--keep", action="store_true", help="jangan hapus direktori kerja sementara")
+    args = parser.parse_args()
+    # Logging dikonfigurasi lebih dulu agar pyftpdlib tidak mencetak setiap perintah FTP
+    logging.basicConfig(level=logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix="dpi-bench-")
+    ftp_root = os.path.join(workdir, "ftp")
+    today = date.today()
+    dates = [today - timedelta(days=offset) for offset in reversed(range(args.days))]
+    count = seed_files(os.path.join(ftp_root, "your_data"), AREAS, dates, {"peta": args.peta_kb, "tabel": args.tabel_kb})
+    print(f"{count} file sintetis dibuat di {ftp_root}")
+
+    ftp_port = free_port()
+    ftp_server = start_ftp_server(ftp_root, ftp_port, args.ftp_latency)
+    app_port = free_port(args.workers)
+    app_ports = [app_port + i for i in range(args.workers)]
+    env = dict(os.environ)
+    env.update({
+        "FTP_URL": "127.0.0.1", "FTP_PORT": str(ftp_port), "FTP_USERNAME": FTP_USER, "FTP_PASSWORD": FTP_PASSWORD,
+        "FTP_PASSIVE": "1", "DPI_SOURCE": "ftp",
+        "DPI_CACHE_DIR": os.path.join(workdir, "cache"), "DPI_COUNTER_DB": os.path.join(workdir, "counts.sqlite3"),
+        "DPI_PREFETCH": "0", "DPI_LOG_LEVEL": "WARNING", "DPI_LOG_LIBRARY_LEVEL": "WARNING",
+    })
+    for item in args.env:
+        name, _, value = item.partition("=")
+        env[name] = value
+    app = start_app(app_port, env, workdir, args.workers)
+    try:
+        pids = worker_pids(app_ports)
+        ports = f"{app_ports[0]}-{app_ports[-1]}" if args.workers > 1 else str(app_port)
+        print(f"Aplikasi berjalan di port {ports} (pid {', '.join(map(str, pids))}), {args.sessions} sesi selama {args.duration:.0f} detik")
+        report = asyncio.run(drive(args, dates, pids, app_ports))
+    finally:
+        app.terminate()
+        try:
+            app.wait(20 if args.workers > 1 else 10)
+        except subprocess.TimeoutExpired:
+            app.kill()
+        ftp_server.close_all()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Hasil disimpan ke {args.json}")
+
+
+if __name__ == "__main__":
+    main()
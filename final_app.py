@@ -2,51 +2,2713 @@ import os
 from shiny import App, ui, render, reactive
 import ftplib
 import tempfile
-import base64
-from datetime import datetime, timedelta
-from dateutil.relativedelta import relativedelta
-import shutil
+from datetime import datetime, timedelta, timezone
+import time
 import logging
+import logging.handlers
+import queue
+import atexit
+import copy
+import asyncio
+import threading
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+import functools
+from collections import OrderedDict, deque
+from email.utils import formatdate, parsedate_to_datetime
+import abc
+import hashlib
+import hmac
+import importlib
+import sqlite3
+import io
+import json
+import math
+import errno
+import struct
+import sys
+import gc
+import types
+import weakref
+import csv
+import zipfile
+import zlib
+import http.client
+import urllib.parse
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+try:
+    from PIL import Image, features as pil_features
+except ImportError:
+    Image = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Set up logging: level dan format dari environment. Record dimasukkan ke antrean dan ditulis
+# oleh thread terpisah, sehingga I/O log tidak pernah memblokir event loop.
+LOG_LEVEL = os.getenv("DPI_LOG_LEVEL", "INFO").upper()
+LOG_LIBRARY_LEVEL = os.getenv("DPI_LOG_LIBRARY_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("DPI_LOG_FORMAT", "json")
+LOG_FIELDS = ("session", "area", "date", "kind")
+# Nomor worker dari serve.py (mode multi-worker); dipasang di setiap record log dan di label metrik
+WORKER_ID = os.getenv("DPI_WORKER_ID")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if WORKER_ID is not None:
+            data["worker"] = WORKER_ID
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+# Pesan digabung dengan argumennya di thread pemanggil (argumen bisa berubah setelahnya),
+# tetapi serialisasi JSON dan penulisan ke stderr terjadi di thread listener
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# Menambahkan id sesi serta area/tanggal yang sedang dilihat ke setiap record dari sesi itu
+class SessionLogger(logging.LoggerAdapter):
+    def __init__(self, logger, session_id, context=None):
+        super().__init__(logger, {"session": session_id})
+        self.context = context
+
+    def process(self, msg, kwargs):
+        extra = dict(self.extra)
+        if self.context is not None:
+            try:
+                extra.update(self.context())
+            except Exception:
+                pass
+        extra.update(kwargs.get("extra") or {})
+        kwargs["extra"] = extra
+        return msg, kwargs
+
+
+def configure_logging(library_level, fmt):
+    output = logging.StreamHandler()
+    if fmt == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        worker = f" worker-{WORKER_ID}" if WORKER_ID is not None else ""
+        output.setFormatter(logging.Formatter(f"%(asctime)s %(levelname)s{worker} %(name)s: %(message)s"))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    atexit.register(listener.stop)
+    # Level aplikasi diatur di logger modul; root menentukan level pustaka (uvicorn, shiny, ...)
+    root = logging.getLogger()
+    root.handlers[:] = [LogQueueHandler(log_queue)]
+    root.setLevel(library_level)
+    return listener
+
+
+log_listener = configure_logging(LOG_LIBRARY_LEVEL, LOG_FORMAT)
 logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+# Metrik gaya Prometheus untuk jalur panas (FTP, cache, render, sesi), dibaca lewat route /metrics.
+# Sengaja dibuat kecil dan tanpa dependensi: counter, gauge, dan histogram dengan label.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in self._values.items()]
+
+    def render(self, const_labels=()):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{format_labels(self.labelnames, key, tuple(const_labels) + tuple(extra))} {value:g}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        super().__init__(name, help, labelnames)
+        self.function = function
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    # Gauge dengan function dibaca saat scrape; function mengembalikan angka
+    # atau dict {tuple label: angka}
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        value = self.function()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [(self.name, key, (), v) for key, v in value.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=METRICS_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += 1
+            state[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, (counts, count, total) in self._values.items():
+                for bound, bucket in zip(self.buckets, counts):
+                    result.append((f"{self.name}_bucket", key, (("le", f"{bound:g}"),), bucket))
+                result.append((f"{self.name}_bucket", key, (("le", "+Inf"),), count))
+                result.append((f"{self.name}_count", key, (), count))
+                result.append((f"{self.name}_sum", key, (), total))
+        return result
+
+
+# const_labels dipasang di setiap sampel, misalnya worker="0" agar metrik dari beberapa worker
+# bisa dibedakan setelah digabung
+class MetricsRegistry:
+    def __init__(self, const_labels=()):
+        self._metrics = []
+        self.const_labels = tuple(const_labels)
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=(), function=None):
+        return self.register(Gauge(name, help, labelnames, function))
+
+    def histogram(self, name, help, labelnames=(), buckets=METRICS_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render(self.const_labels))
+            except Exception as e:
+                logger.error("Metrik %s gagal dibaca: %s", metric.name, e)
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry((("worker", WORKER_ID),) if WORKER_ID is not None else ())
+FTP_SECONDS = metrics.histogram("dpi_ftp_seconds", "Durasi operasi FTP (connect, login, retr, list, stat)", ["operation"])
+FTP_ERRORS = metrics.counter("dpi_ftp_errors_total", "Operasi FTP yang gagal", ["operation"])
+FETCH_SECONDS = metrics.histogram("dpi_fetch_seconds", "Durasi pengambilan satu file dari sumber gambar ke cache", ["kind", "result"])
+CACHE_REQUESTS = metrics.counter("dpi_cache_requests_total", "Pencarian di cache gambar", ["cache", "result"])
+VARIANT_SECONDS = metrics.histogram("dpi_variant_render_seconds", "Durasi membuat varian gambar (resize dan encode)", ["size", "format"])
+RENDER_SECONDS = metrics.histogram("dpi_render_seconds", "Durasi render output Shiny", ["output"])
+HTTP_REQUESTS = metrics.counter("dpi_image_requests_total", "Permintaan ke route /dpi", ["status"])
+TRANSFER_RETRIES = metrics.counter("dpi_transfer_retries_total", "Transfer yang dilanjutkan atau diulang", ["reason"])
+REVALIDATIONS = metrics.counter("dpi_revalidations_total", "Pemeriksaan ulang file di cache terhadap sumber gambar", ["result"])
+ACTIVE_SESSIONS = metrics.gauge("dpi_active_sessions", "Jumlah sesi Shiny yang aktif")
+
+
+# Ukur durasi render sebuah output; dipasang di bawah decorator @render.*
+def timed_render(output_name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with RENDER_SECONDS.time(output=output_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Batas jumlah unduhan FTP yang berjalan bersamaan (di semua sesi)
+FTP_MAX_CONCURRENT = int(os.getenv("FTP_MAX_CONCURRENT", "4"))
+ftp_executor = ThreadPoolExecutor(max_workers=FTP_MAX_CONCURRENT, thread_name_prefix="dpi-ftp")
+# Unduhan latar belakang (prefetch, pemanasan cache) memakai executor sendiri yang lebih kecil,
+# sehingga tidak pernah mengantre di depan unduhan yang diminta pengguna
+BACKGROUND_CONCURRENCY = max(1, min(int(os.getenv("DPI_BACKGROUND_CONCURRENCY", "1")), FTP_MAX_CONCURRENT - 1))
+background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_CONCURRENCY, thread_name_prefix="dpi-ftp-bg")
+
+# Konfigurasi koneksi FTP
+FTP_URL = os.getenv("FTP_URL", "isisendiri")
+FTP_PORT = int(os.getenv("FTP_PORT", "21"))
+FTP_USERNAME = os.getenv("FTP_USERNAME", "isisendiri")
+FTP_PASSWORD = os.getenv("FTP_PASSWORD", "isisendiri")
+FTP_BASE_PATH = os.getenv("FTP_BASE_PATH", "your_data")
+FTP_TIMEOUT = float(os.getenv("FTP_TIMEOUT", "60"))
+FTP_PASSIVE = os.getenv("FTP_PASSIVE", "0") == "1"
+# Koneksi tambahan untuk unduhan latar belakang, agar unduhan pengguna tidak menunggu koneksi
+FTP_POOL_SIZE = int(os.getenv("FTP_POOL_SIZE", str(FTP_MAX_CONCURRENT + BACKGROUND_CONCURRENCY)))
+FTP_KEEPALIVE_INTERVAL = float(os.getenv("FTP_KEEPALIVE_INTERVAL", "30"))
+FTP_MAX_IDLE = float(os.getenv("FTP_MAX_IDLE", "300"))
+
+# Daftar area WPP NRI yang tersedia
+AREAS = ["571", "572", "573", "711", "712", "713", "714", "715", "716", "717", "718"]
+KINDS = ["peta", "tabel"]
+
+# Konfigurasi cache gambar DPI di disk (dipakai bersama oleh semua sesi)
+CACHE_DIR = os.getenv("DPI_CACHE_DIR", os.path.join(tempfile.gettempdir(), "dpi_images"))
+CACHE_MAX_BYTES = int(float(os.getenv("DPI_CACHE_MAX_MB", "512")) * 1024 * 1024)
+CACHE_MAX_AGE = int(float(os.getenv("DPI_CACHE_MAX_AGE_HOURS", "72")) * 3600)
+CACHE_WARM_ON_START = os.getenv("DPI_CACHE_WARM", "0") == "1"
+CACHE_LOCK_STRIPES = int(os.getenv("DPI_CACHE_LOCK_STRIPES", "256"))
+
+# Lama (detik) browser boleh memakai gambar DPI dari cache-nya sebelum revalidasi
+DPI_IMAGE_MAX_AGE = int(os.getenv("DPI_IMAGE_MAX_AGE", "300"))
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+# Isi file yang diterima tidak utuh (ukuran tidak cocok dengan SIZE di server, atau struktur PNG rusak)
+class CorruptDownload(Exception):
+    pass
+
+
+def dpi_filename(kind, area, date_str):
+    return f"{kind}_dpi_{area}_{date_str}.png"
+
+
+DPI_FILENAME_RE = re.compile(r"^(?P<kind>peta|tabel)_dpi_(?P<area>\d+)_(?P<date>\d{8})\.png$")
+
+
+def dpi_key(path):
+    match = DPI_FILENAME_RE.match(os.path.basename(path))
+    if not match:
+        return None
+    return (match.group("kind"), match.group("area"), match.group("date"))
+
+
+# URL gambar untuk dipakai di <img>; parameter v berubah jika file diperbarui
+def dpi_image_url(path):
+    key = dpi_key(path)
+    entry = payload_cache.lookup(key) if key else None
+    if entry is not None:
+        return entry.url
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"dpi/{os.path.basename(path)}?v={stat.st_mtime_ns}"
+
+
+# Kunci antar-proses (flock) untuk mode multi-worker: beberapa proses uvicorn berbagi satu
+# folder cache. Nama file dipetakan ke sejumlah tetap file kunci (stripe), sehingga jumlah
+# file kunci tidak bertambah dan tidak perlu dihapus. Peta dan tabel untuk area/tanggal yang
+# sama selalu jatuh ke stripe berbeda agar keduanya bisa diunduh bersamaan. Tanpa fcntl
+# (Windows) hanya kunci dalam proses yang berlaku, jadi mode multi-worker tidak didukung di sana.
+class ProcessLocks:
+    def __init__(self, directory, stripes):
+        self.directory = directory
+        self.groups = max(1, stripes // len(KINDS))
+
+    def index(self, name):
+        match = DPI_FILENAME_RE.match(name.lstrip(".").removesuffix(".part"))
+        if match is None:
+            return zlib.crc32(name.encode()) % (self.groups * len(KINDS))
+        group = zlib.crc32(f"{match['area']}_{match['date']}".encode()) % self.groups
+        return group * len(KINDS) + KINDS.index(match["kind"])
+
+    def path(self, name):
+        return os.path.join(self.directory, f"{self.index(name):03d}.lock")
+
+    @contextmanager
+    def hold(self, name):
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # flock berlaku per file yang dibuka, jadi thread dalam proses yang sama juga saling menunggu
+        with open(self.path(name), "ab") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+# Satu worker menjalankan tugas latar belakang (prefetch dan listing ketersediaan); worker lain
+# cukup membaca hasilnya dari disk. Kunci dilepas oleh OS saat worker berhenti, lalu diambil
+# alih oleh worker lain pada pemeriksaan berikutnya.
+class Leadership:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._file is not None or fcntl is None:
+                return True
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            f = open(self.path, "ab")
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+            self._file = f
+        logger.info("Worker %s (pid %s) menjalankan tugas latar belakang", WORKER_ID or "-", os.getpid())
+        return True
+
+    def held(self):
+        return self._file is not None or fcntl is None
+
+
+# Cache gambar DPI di disk dengan kunci (kind, area, YYYYMMDD).
+# File ditulis ke file .part lalu di-rename ke tempatnya (atomik), sehingga sesi lain
+# tidak pernah membaca file yang setengah jadi. File .part dari transfer yang terputus
+# disimpan dan dilanjutkan oleh unduhan berikutnya. Eviction berdasarkan umur dan ukuran (LRU).
+class DpiCache:
+    def __init__(self, directory, max_bytes, max_age, lock_stripes=CACHE_LOCK_STRIPES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._writing = {}
+        self.process_locks = ProcessLocks(os.path.join(directory, ".locks"), lock_stripes)
+        self.listeners = []
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, kind, area, date_str):
+        return os.path.join(self.directory, dpi_filename(kind, area, date_str))
+
+    def partial_path(self, kind, area, date_str):
+        return os.path.join(self.directory, f".{dpi_filename(kind, area, date_str)}.part")
+
+    # Satu penulis per file .part, di proses ini (unduhan biasa dan revalidasi bisa bertemu)
+    # maupun di semua worker yang memakai folder cache yang sama. Kunci per path dihitung
+    # pemakainya dan dibuang saat tidak ada lagi yang memegang atau menunggunya.
+    @contextmanager
+    def _writer_lock(self, path):
+        with self._lock:
+            entry = self._writing.get(path)
+            if entry is None:
+                entry = self._writing[path] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0], self.process_locks.hold(os.path.basename(path)):
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._writing[path]
+
+    def get(self, kind, area, date_str):
+        path = self.path(kind, area, date_str)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            CACHE_REQUESTS.inc(cache="disk", result="miss")
+            return None
+        now = time.time()
+        if self.max_age and now - stat.st_mtime > self.max_age:
+            logger.debug("Cache kedaluwarsa: %s", path)
+            self._remove(path)
+            CACHE_REQUESTS.inc(cache="disk", result="miss")
+            return None
+        # Catat waktu akses untuk LRU (mtime tetap menandai waktu unduh)
+        try:
+            os.utime(path, (now, stat.st_mtime))
+        except FileNotFoundError:
+            CACHE_REQUESTS.inc(cache="disk", result="miss")
+            return None
+        CACHE_REQUESTS.inc(cache="disk", result="hit")
+        return path
+
+    # writer menerima file .part yang posisinya di akhir data yang sudah ada (f.tell() = offset
+    # untuk melanjutkan). Bila writer gagal, .part disimpan untuk dilanjutkan, kecuali isinya
+    # rusak atau kosong. Dengan replace=False, file yang sudah diunduh worker lain selama
+    # menunggu kunci langsung dipakai dan writer tidak dipanggil.
+    def store(self, kind, area, date_str, writer, replace=True):
+        final_path = self.path(kind, area, date_str)
+        tmp_path = self.partial_path(kind, area, date_str)
+        os.makedirs(self.directory, exist_ok=True)
+        with self._writer_lock(tmp_path):
+            if not replace and os.path.exists(final_path):
+                logger.debug("File sudah diunduh oleh worker lain: %s", final_path)
+                return final_path
+            try:
+                # Bukan mode append: sendfile() menolak file tujuan dengan O_APPEND
+                with os.fdopen(os.open(tmp_path, os.O_RDWR | os.O_CREAT, 0o644), "r+b") as f:
+                    f.seek(0, os.SEEK_END)
+                    writer(f)
+                os.replace(tmp_path, final_path)
+            except CorruptDownload:
+                self._remove(tmp_path)
+                raise
+            except BaseException:
+                try:
+                    if os.path.getsize(tmp_path) == 0:
+                        self._remove(tmp_path)
+                except FileNotFoundError:
+                    pass
+                raise
+        for listener in self.listeners:
+            listener(kind, area, date_str)
+        self.evict()
+        return final_path
+
+    def evict(self):
+        with self._lock:
+            now = time.time()
+            entries = []
+            for entry in os.scandir(self.directory):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith(".part"):
+                    # Sisa unduhan yang terputus
+                    if now - stat.st_mtime > 3600:
+                        self._remove(entry.path)
+                    continue
+                if not entry.name.endswith(".png"):
+                    continue
+                if self.max_age and now - stat.st_mtime > self.max_age:
+                    self._remove(entry.path)
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            if self.max_bytes and total > self.max_bytes:
+                for _, size, path in sorted(entries):
+                    if total <= self.max_bytes:
+                        break
+                    self._remove(path)
+                    total -= size
+                    logger.debug("Cache dihapus (LRU): %s", path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+dpi_cache = DpiCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_MAX_AGE)
+background_leader = Leadership(os.path.join(CACHE_DIR, ".locks", "leader.lock"))
+
+
+# Cache isi gambar di memori (dipakai bersama oleh semua sesi), dibatasi jumlah byte.
+# Menyimpan byte mentah beserta turunannya (ETag, Last-Modified, URL, dan encoding lain)
+# per (kind, area, YYYYMMDD), sehingga menampilkan ulang gambar atau membuka modal
+# "Diperbesar" tidak perlu membaca disk lagi.
+PAYLOAD_CACHE_MAX_BYTES = int(float(os.getenv("DPI_MEMORY_CACHE_MB", "128")) * 1024 * 1024)
+PAYLOAD_REVALIDATE_SECONDS = float(os.getenv("DPI_MEMORY_CACHE_REVALIDATE", "5"))
+
+
+# Lebar gambar dibaca langsung dari header IHDR PNG, tanpa decode
+def png_width(data):
+    if data[:8] != b"\x89PNG\r\n\x1a\n" or data[12:16] != b"IHDR":
+        return None
+    return int.from_bytes(data[16:20], "big")
+
+
+class Payload:
+    def __init__(self, key, path, data, stat):
+        self.key = key
+        self.path = path
+        self.data = data
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.etag = f'"{hashlib.md5(data, usedforsecurity=False).hexdigest()}"'
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self.url = f"dpi/{os.path.basename(path)}?v={stat.st_mtime_ns}"
+        self.width = png_width(data)
+        self.derived = {}
+        self.deriving = {}
+        self.checked_at = time.monotonic()
+
+    @property
+    def nbytes(self):
+        return len(self.data) + sum(len(value) for value in self.derived.values())
+
+
+class PayloadCache:
+    def __init__(self, max_bytes, revalidate_seconds):
+        self.max_bytes = max_bytes
+        self.revalidate_seconds = revalidate_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    # Ambil entri tanpa membaca isi file; file hanya di-stat ulang paling sering sekali per
+    # revalidate_seconds untuk mendeteksi perubahan dari luar proses ini
+    def lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                CACHE_REQUESTS.inc(cache="memory", result="miss")
+                return None
+            if time.monotonic() - entry.checked_at < self.revalidate_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                CACHE_REQUESTS.inc(cache="memory", result="hit")
+                return entry
+        try:
+            stat = os.stat(entry.path)
+            changed = (stat.st_mtime_ns, stat.st_size) != (entry.mtime_ns, entry.size)
+        except FileNotFoundError:
+            changed = True
+        with self._lock:
+            if changed:
+                self._drop(key)
+                self.invalidations += 1
+                self.misses += 1
+                CACHE_REQUESTS.inc(cache="memory", result="miss")
+                return None
+            entry.checked_at = time.monotonic()
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+            CACHE_REQUESTS.inc(cache="memory", result="hit")
+            return entry
+
+    def load(self, key, path):
+        entry = self.lookup(key)
+        if entry is not None:
+            return entry
+        try:
+            with open(path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                if self.max_bytes and stat.st_size > self.max_bytes:
+                    return None
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        entry = Payload(key, path, data, stat)
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = entry
+            self._bytes += entry.nbytes
+            self._evict()
+        return entry
+
+    # Simpan turunan dari byte mentah (misalnya encoding lain) di entri yang sama. Permintaan
+    # bersamaan untuk turunan yang sama menunggu satu pemanggilan fn (seperti single-flight FTP).
+    def derive(self, entry, name, fn):
+        with self._lock:
+            value = entry.derived.get(name)
+            if value is not None:
+                return value
+            future = entry.deriving.get(name)
+            owner = future is None
+            if owner:
+                future = entry.deriving[name] = Future()
+        if not owner:
+            return future.result()
+        try:
+            value = fn(entry.data)
+        except BaseException as e:
+            with self._lock:
+                entry.deriving.pop(name, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            entry.deriving.pop(name, None)
+            if self._entries.get(entry.key) is entry and name not in entry.derived:
+                entry.derived[name] = value
+                self._bytes += len(value)
+                self._evict()
+        future.set_result(value)
+        return value
+
+    def invalidate(self, kind, area, date_str):
+        with self._lock:
+            if self._drop((kind, area, date_str)):
+                self.invalidations += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.nbytes
+        return entry is not None
+
+    def _evict(self):
+        while self.max_bytes and self._bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.nbytes
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 3) if total else None,
+                "invalidations": self.invalidations,
+            }
+
+
+payload_cache = PayloadCache(PAYLOAD_CACHE_MAX_BYTES, PAYLOAD_REVALIDATE_SECONDS)
+metrics.gauge("dpi_memory_cache_bytes", "Ukuran cache isi gambar di memori", function=lambda: payload_cache._bytes)
+dpi_cache.listeners.append(payload_cache.invalidate)
+
+
+def preload_payload(path):
+    key = dpi_key(path) if path else None
+    if key:
+        payload_cache.load(key, path)
+
+
+# Varian gambar dengan resolusi lebih kecil (dan format WebP/AVIF jika didukung Pillow),
+# dibuat di server dan disimpan sebagai turunan di cache memori. Browser memilih varian
+# lewat srcset; tombol unduh tetap mengirim file asli.
+def parse_variant_widths(value):
+    widths = {}
+    for item in value.split(","):
+        name, _, width = item.strip().partition(":")
+        if name and width.isdigit():
+            widths[name] = int(width)
+    return widths
+
+
+VARIANT_WIDTHS = parse_variant_widths(os.getenv("DPI_VARIANT_WIDTHS", "thumb:480,inline:1200"))
+VARIANT_QUALITY = int(os.getenv("DPI_VARIANT_QUALITY", "80"))
+VARIANT_FORMATS = [
+    fmt for fmt in (item.strip().lower() for item in os.getenv("DPI_VARIANT_FORMATS", "webp").split(","))
+    if fmt in ("webp", "avif") and Image is not None and pil_features.check(fmt)
+]
+VARIANT_MEDIA_TYPES = {"png": "image/png", "webp": "image/webp", "avif": "image/avif"}
+
+INLINE_IMAGE_STYLE = "max-width:100%; max-height:600px; display: block; margin: 0 auto;"
+INLINE_IMAGE_SIZES = "(max-width: 1200px) 100vw, 1200px"
+MODAL_IMAGE_STYLE = "max-width:100%; max-height:700px;"
+MODAL_IMAGE_SIZES = "(max-width: 800px) 100vw, 800px"
+
+
+def render_variant(data, width, fmt):
+    with Image.open(io.BytesIO(data)) as img:
+        img.load()
+        if width and img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+        out = io.BytesIO()
+        if fmt == "png":
+            img.save(out, "PNG", optimize=True)
+        else:
+            img.save(out, fmt.upper(), quality=VARIANT_QUALITY)
+        return out.getvalue()
+
+
+# Kembalikan (data, media_type, etag) untuk varian yang diminta; None berarti kirim file asli
+def get_variant(entry, size, fmt):
+    if Image is None or (size == "full" and fmt == "png"):
+        return None
+    width = VARIANT_WIDTHS.get(size) if size != "full" else None
+
+    # Varian yang justru lebih besar dari file asli disimpan sebagai b"" dan tidak dipakai
+    def buat(raw):
+        with VARIANT_SECONDS.time(size=size, format=fmt):
+            data = render_variant(raw, width, fmt)
+        return data if len(data) < len(raw) else b""
+
+    try:
+        data = payload_cache.derive(entry, f"{size}.{fmt}", buat)
+    except Exception as e:
+        logger.error("Gagal membuat varian %s.%s untuk %s: %s", size, fmt, entry.path, e)
+        return None
+    if not data:
+        return None
+    return data, VARIANT_MEDIA_TYPES[fmt], f'{entry.etag[:-1]}-{size}-{fmt}"'
+
+
+def variant_srcset(entry, fmt):
+    items = []
+    for name, width in VARIANT_WIDTHS.items():
+        if width < entry.width:
+            items.append(f"{entry.url}&size={name}&format={fmt} {width}w")
+    full_url = entry.url if fmt == "png" else f"{entry.url}&size=full&format={fmt}"
+    items.append(f"{full_url} {entry.width}w")
+    return ", ".join(items)
+
+
+def dpi_image_tag(path, style, sizes):
+    key = dpi_key(path)
+    entry = payload_cache.lookup(key) if key else None
+    if entry is None or not entry.width or Image is None:
+        src = dpi_image_url(path)
+        return ui.tags.img({"src": src, "style": style}) if src else None
+    img = ui.tags.img({"src": entry.url, "srcset": variant_srcset(entry, "png"), "sizes": sizes, "style": style})
+    if not VARIANT_FORMATS:
+        return img
+    sources = [ui.tags.source(type=VARIANT_MEDIA_TYPES[fmt], srcset=variant_srcset(entry, fmt), sizes=sizes) for fmt in VARIANT_FORMATS]
+    return ui.tags.picture(*sources, img)
+
+
+# Error yang menandakan koneksi FTP sudah tidak bisa dipakai lagi
+FTP_CONNECTION_ERRORS = (OSError, EOFError, ftplib.error_temp, ftplib.error_reply)
+
+
+class PooledFtp:
+    def __init__(self, ftp):
+        self.ftp = ftp
+        self.last_used = time.monotonic()
+
+
+# Durasi dan error per operasi FTP untuk /metrics; pembatalan tidak dihitung sebagai error
+@contextmanager
+def timed_ftp(operation):
+    start = time.perf_counter()
+    try:
+        yield
+    except DownloadCancelled:
+        raise
+    except Exception:
+        FTP_ERRORS.inc(operation=operation)
+        raise
+    finally:
+        FTP_SECONDS.observe(time.perf_counter() - start, operation=operation)
+
+
+# Pool koneksi FTP yang sudah login, dipakai ulang oleh semua unduhan dan sesi.
+# Koneksi yang menganggur dijaga dengan NOOP, dicek sebelum dipakai, dan dibuat ulang
+# secara otomatis jika socket sudah basi.
+class FtpPool:
+    def __init__(self, host, port, username, password, max_size, passive, timeout, keepalive_interval, max_idle):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_size = max_size
+        self.passive = passive
+        self.timeout = timeout
+        self.keepalive_interval = keepalive_interval
+        self.max_idle = max_idle
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle = []
+        self._keepalive_thread = None
+        self.connections_opened = 0
+
+    def _connect(self):
+        ftp = ftplib.FTP(timeout=self.timeout)
+        with timed_ftp("connect"):
+            ftp.connect(self.host, self.port)
+        try:
+            with timed_ftp("login"):
+                ftp.login(self.username, self.password)
+        except BaseException:
+            ftp.close()
+            raise
+        ftp.set_pasv(self.passive)
+        with self._lock:
+            self.connections_opened += 1
+        logger.debug("Koneksi FTP baru ke %s:%s (pasif: %s)", self.host, self.port, self.passive)
+        return PooledFtp(ftp)
+
+    def _close(self, conn):
+        try:
+            conn.ftp.quit()
+        except Exception:
+            conn.ftp.close()
+
+    def _healthy(self, conn):
+        try:
+            conn.ftp.voidcmd("NOOP")
+            return True
+        except FTP_CONNECTION_ERRORS:
+            return False
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            self._start_keepalive()
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    return self._connect()
+                idle_for = time.monotonic() - conn.last_used
+                if idle_for > self.max_idle:
+                    self._close(conn)
+                    continue
+                # Koneksi yang sudah lama diam dicek dulu sebelum dipakai
+                if idle_for > 5 and not self._healthy(conn):
+                    logger.debug("Koneksi FTP basi dibuang dari pool")
+                    conn.ftp.close()
+                    continue
+                return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, conn, reusable):
+        try:
+            if reusable:
+                conn.last_used = time.monotonic()
+                with self._lock:
+                    self._idle.append(conn)
+            else:
+                conn.ftp.close()
+        finally:
+            self._slots.release()
+
+    # Unduh satu file (mulai dari byte rest bila diberikan); jika koneksi ternyata basi sebelum
+    # ada data yang diterima, koneksi dibuat ulang dan RETR diulang sekali secara transparan.
+    # Pemanggil yang punya loop percobaan sendiri (fetch_image) memakai retry=False agar
+    # percobaannya tidak berlipat. Timeout tidak pernah diulang: server yang macet tidak
+    # menjadi lebih cepat dengan koneksi baru.
+    def retrbinary(self, remote_path, callback, rest=None, retry=True):
+        for attempt in range(2 if retry else 1):
+            received = [False]
+
+            def on_data(data):
+                received[0] = True
+                callback(data)
+
+            conn = self._acquire()
+            reusable = False
+            try:
+                with timed_ftp("retr"):
+                    conn.ftp.retrbinary(f"RETR {remote_path}", on_data, rest=rest)
+                reusable = True
+                return
+            except ftplib.error_perm:
+                reusable = True
+                raise
+            except FTP_CONNECTION_ERRORS as e:
+                if retry and attempt == 0 and not received[0] and not isinstance(e, TimeoutError):
+                    logger.debug("Koneksi FTP terputus (%r), mencoba ulang dengan koneksi baru", e)
+                    continue
+                raise
+            finally:
+                self._release(conn, reusable)
+
+    # Jalankan perintah FTP lain (listing, MLST, dst.) dengan koneksi dari pool;
+    # dicoba sekali lagi dengan koneksi baru jika koneksi lama ternyata terputus
+    def call(self, operation):
+        for attempt in range(2):
+            conn = self._acquire()
+            reusable = False
+            try:
+                result = operation(conn.ftp)
+                reusable = True
+                return result
+            except ftplib.error_perm:
+                reusable = True
+                raise
+            except FTP_CONNECTION_ERRORS as e:
+                if attempt == 0 and not isinstance(e, TimeoutError):
+                    logger.debug("Koneksi FTP terputus (%r), mencoba ulang dengan koneksi baru", e)
+                    continue
+                raise
+            finally:
+                self._release(conn, reusable)
+
+    def _start_keepalive(self):
+        if self.keepalive_interval <= 0 or self._keepalive_thread is not None:
+            return
+        with self._lock:
+            if self._keepalive_thread is not None:
+                return
+            self._keepalive_thread = threading.Thread(target=self._keepalive_loop, name="dpi-ftp-keepalive", daemon=True)
+        self._keepalive_thread.start()
+
+    def _keepalive_loop(self):
+        while True:
+            time.sleep(self.keepalive_interval)
+            with self._lock:
+                idle, self._idle = self._idle, []
+            keep = []
+            now = time.monotonic()
+            for conn in idle:
+                if now - conn.last_used > self.max_idle:
+                    self._close(conn)
+                elif self._healthy(conn):
+                    keep.append(conn)
+                else:
+                    conn.ftp.close()
+            with self._lock:
+                self._idle = keep + self._idle
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._close(conn)
+
+
+ftp_pool = FtpPool(
+    FTP_URL, FTP_PORT, FTP_USERNAME, FTP_PASSWORD,
+    max_size=FTP_POOL_SIZE,
+    passive=FTP_PASSIVE,
+    timeout=FTP_TIMEOUT,
+    keepalive_interval=FTP_KEEPALIVE_INTERVAL,
+    max_idle=FTP_MAX_IDLE,
+)
+metrics.gauge("dpi_ftp_connections_opened", "Jumlah koneksi FTP yang pernah dibuka pool", function=lambda: ftp_pool.connections_opened)
+metrics.gauge("dpi_ftp_connections_idle", "Koneksi FTP menganggur di pool", function=lambda: len(ftp_pool._idle))
+
+
+# Sumber gambar DPI. download_from_ftp hanya memakai antarmuka ImageSource, sehingga gambar
+# bisa diambil dari FTP (default), dari direktori lokal/NFS yang ditulis langsung oleh
+# pipeline prakiraan (tanpa jaringan), atau dari server HTTP. Dipilih lewat DPI_SOURCE.
+SOURCE_BACKEND = os.getenv("DPI_SOURCE", "ftp")
+SOURCE_DIR = os.getenv("DPI_SOURCE_DIR", FTP_BASE_PATH)
+SOURCE_HTTP_URL = os.getenv("DPI_SOURCE_URL", "")
+SOURCE_HTTP_POOL_SIZE = int(os.getenv("DPI_SOURCE_HTTP_POOL_SIZE", str(FTP_MAX_CONCURRENT)))
+SOURCE_CHUNK_SIZE = 1024 * 1024
+
+
+def check_cancelled(cancel_event, name):
+    if cancel_event is not None and cancel_event.is_set():
+        raise DownloadCancelled(f"Unduhan {name} dibatalkan")
+
+
+def format_modify(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y%m%d%H%M%S")
+
+
+def modify_timestamp(modify):
+    return datetime.strptime(modify[:14], "%Y%m%d%H%M%S").replace(tzinfo=timezone.utc).timestamp()
+
+
+class ImageSource(abc.ABC):
+    # True bila retrieve() dapat melanjutkan dari offset (REST di FTP, Range di HTTP)
+    resumable = False
+
+    # Tulis isi file ke f mulai dari byte offset; hentikan dengan DownloadCancelled bila
+    # cancel_event di-set. File yang tidak ada: FileNotFoundError; gangguan sementara: OSError lain
+    @abc.abstractmethod
+    def retrieve(self, name, f, cancel_event=None, offset=0):
+        pass
+
+    # Nama file -> waktu modifikasi (YYYYMMDDHHMMSS UTC, atau None); None bila tidak didukung
+    def listdir(self):
+        return None
+
+    # Waktu modifikasi direktori untuk melewati listing yang tidak berubah; None bila tidak diketahui
+    def modified(self):
+        return None
+
+    # (modify, size) satu file untuk revalidasi cache; None bila tidak didukung,
+    # masing-masing komponen None bila server tidak memberikannya
+    def stat(self, name):
+        return None
+
+    def describe(self, name):
+        return name
+
+
+class FtpSource(ImageSource):
+    resumable = True
+
+    def __init__(self, pool, base_path):
+        self.pool = pool
+        self.base_path = base_path
+
+    def retrieve(self, name, f, cancel_event=None, offset=0):
+        def callback(data):
+            check_cancelled(cancel_event, name)
+            f.write(data)
+        check_cancelled(cancel_event, name)
+        # Percobaan ulang diatur fetch_image, bukan pool
+        self.pool.retrbinary(f"{self.base_path}/{name}", callback, rest=offset or None, retry=False)
+
+    def listdir(self):
+        with timed_ftp("list"):
+            return self.pool.call(self._listdir)
+
+    def _listdir(self, ftp):
+        try:
+            return {name: facts.get("modify") for name, facts in ftp.mlsd(self.base_path) if facts.get("type", "file") == "file"}
+        except ftplib.error_perm as e:
+            if not str(e).startswith("50"):
+                raise
+        # Server tanpa MLSD: NLST hanya memberi nama file
+        try:
+            names = ftp.nlst(self.base_path)
+        except ftplib.error_perm as e:
+            # Sebagian server menjawab 550 untuk direktori kosong
+            if "No files" in str(e):
+                return {}
+            raise
+        return {os.path.basename(name): None for name in names}
+
+    def modified(self):
+        return self.pool.call(self._modified)
+
+    def _modified(self, ftp):
+        try:
+            response = ftp.sendcmd(f"MLST {self.base_path}")
+        except ftplib.error_perm:
+            return None
+        match = re.search(r"modify=(\d+)", response, re.IGNORECASE)
+        return match.group(1) if match else None
+
+    def stat(self, name):
+        with timed_ftp("stat"):
+            return self.pool.call(lambda ftp: self._stat(ftp, f"{self.base_path}/{name}"))
+
+    # MDTM dan SIZE hanya beberapa byte per perintah; SIZE butuh mode biner di banyak server
+    def _stat(self, ftp, path):
+        try:
+            modify = ftp.sendcmd(f"MDTM {path}").split()[-1]
+        except ftplib.error_perm:
+            modify = None
+        try:
+            ftp.voidcmd("TYPE I")
+            size = ftp.size(path)
+        except ftplib.error_perm:
+            size = None
+        return modify, size
+
+    def describe(self, name):
+        return f"ftp://{self.pool.host}/{self.base_path}/{name}"
+
+
+# Direktori di host yang sama (atau NFS): isi file disalin kernel ke cache dengan sendfile
+class LocalSource(ImageSource):
+    resumable = True
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def retrieve(self, name, f, cancel_event=None, offset=0):
+        check_cancelled(cancel_event, name)
+        with open(os.path.join(self.directory, name), "rb") as src:
+            if self._sendfile(name, src, f, cancel_event, offset):
+                return
+            src.seek(offset)
+            while True:
+                check_cancelled(cancel_event, name)
+                chunk = src.read(SOURCE_CHUNK_SIZE)
+                if not chunk:
+                    return
+                f.write(chunk)
+
+    # False bila sendfile file-ke-file tidak didukung; pemanggil lalu menyalin biasa
+    def _sendfile(self, name, src, f, cancel_event, offset=0):
+        if not hasattr(os, "sendfile"):
+            return False
+        f.flush()
+        start = offset
+        while True:
+            check_cancelled(cancel_event, name)
+            try:
+                sent = os.sendfile(f.fileno(), src.fileno(), offset, SOURCE_CHUNK_SIZE)
+            except OSError as e:
+                if offset == start and e.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    return False
+                raise
+            if sent == 0:
+                return True
+            offset += sent
+
+    def listdir(self):
+        files = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                files[entry.name] = format_modify(entry.stat().st_mtime)
+        return files
+
+    def modified(self):
+        return format_modify(os.stat(self.directory).st_mtime)
+
+    def stat(self, name):
+        try:
+            stat = os.stat(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            return None, None
+        return format_modify(stat.st_mtime), stat.st_size
+
+    def describe(self, name):
+        return os.path.join(self.directory, name)
+
+
+# Server HTTP(S) dengan koneksi keep-alive yang dipakai ulang (pool), mirip FtpPool.
+# Listing dibaca dari halaman indeks direktori (autoindex nginx/Apache) bila tersedia.
+class HttpSource(ImageSource):
+    resumable = True
+
+    def __init__(self, base_url, max_size, timeout):
+        parts = urllib.parse.urlsplit(base_url)
+        self.base_url = base_url.rstrip("/")
+        self.host = parts.netloc
+        self.base_path = parts.path.rstrip("/")
+        self.timeout = timeout
+        self._connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _acquire(self):
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connection_class(self.host, timeout=self.timeout)
+
+    def _release(self, conn, reusable):
+        if reusable:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    # Kirim permintaan; koneksi keep-alive yang sudah ditutup server dicoba sekali lagi
+    # (timeout tidak, sama seperti FtpPool)
+    def _request(self, path, method="GET", headers=None):
+        for attempt in range(2):
+            conn = self._acquire()
+            try:
+                conn.request(method, path, headers=headers or {})
+                return conn, conn.getresponse()
+            except (http.client.HTTPException, OSError) as e:
+                self._release(conn, False)
+                if attempt == 0 and not isinstance(e, TimeoutError):
+                    continue
+                raise
+
+    # restart dipanggil bila server mengabaikan Range dan mengirim file dari awal, atau menolak
+    # Range (416, misalnya file diganti yang lebih kecil) sehingga file diminta ulang dari awal.
+    # Hanya 404/410 yang berarti file tidak ada; status lain dianggap gangguan sementara.
+    def _get(self, path, write, cancel_event=None, name=None, headers=None, restart=None):
+        conn, response = self._request(path, headers=headers)
+        reusable = False
+        try:
+            if response.status not in (200, 206):
+                response.read()
+                reusable = not response.will_close
+                if response.status == 416 and restart is not None:
+                    restart()
+                elif response.status in (404, 410):
+                    raise FileNotFoundError(f"HTTP {response.status} {response.reason}: {path}")
+                elif response.status in (401, 403):
+                    raise PermissionError(f"HTTP {response.status} {response.reason}: {path}")
+                else:
+                    raise ConnectionError(f"HTTP {response.status} {response.reason}: {path}")
+            else:
+                if response.status == 200 and restart is not None:
+                    restart()
+                while True:
+                    check_cancelled(cancel_event, name or path)
+                    chunk = response.read(SOURCE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    write(chunk)
+                reusable = not response.will_close
+        finally:
+            self._release(conn, reusable)
+        if response.status == 416:
+            self._get(path, write, cancel_event, name)
+
+    def retrieve(self, name, f, cancel_event=None, offset=0):
+        def restart():
+            f.seek(0)
+            f.truncate()
+        headers = {"Range": f"bytes={offset}-"} if offset else None
+        self._get(f"{self.base_path}/{urllib.parse.quote(name)}", f.write, cancel_event, name, headers, restart if offset else None)
+
+    def listdir(self):
+        page = io.BytesIO()
+        try:
+            self._get(f"{self.base_path}/", page.write)
+        except (FileNotFoundError, PermissionError):
+            # Indeks direktori tidak ada atau dimatikan (autoindex off)
+            return None
+        names = re.findall(r'href="([^"?/]+)"', page.getvalue().decode("utf-8", "replace"))
+        return {urllib.parse.unquote(name): None for name in names}
+
+    # HEAD: Last-Modified dan Content-Length tanpa mengirim isi file
+    def stat(self, name):
+        conn, response = self._request(f"{self.base_path}/{urllib.parse.quote(name)}", "HEAD")
+        try:
+            response.read()
+        finally:
+            self._release(conn, not response.will_close)
+        if response.status != 200:
+            return None, None
+        modify = response.getheader("Last-Modified")
+        size = response.getheader("Content-Length")
+        try:
+            modify = format_modify(parsedate_to_datetime(modify).timestamp()) if modify else None
+        except (TypeError, ValueError):
+            modify = None
+        return modify, int(size) if size and size.isdigit() else None
+
+    def describe(self, name):
+        return f"{self.base_url}/{name}"
+
+
+def create_image_source(backend):
+    if backend == "ftp":
+        return FtpSource(ftp_pool, FTP_BASE_PATH)
+    if backend == "local":
+        return LocalSource(SOURCE_DIR)
+    if backend == "http":
+        return HttpSource(SOURCE_HTTP_URL, SOURCE_HTTP_POOL_SIZE, FTP_TIMEOUT)
+    # Sumber lain bisa dipasang dengan format "modul:NamaKelas"
+    module_name, _, attr = backend.partition(":")
+    return getattr(importlib.import_module(module_name), attr)()
+
+
+image_source = create_image_source(SOURCE_BACKEND)
+
+
+# Transfer yang bisa dilanjutkan dan diperiksa keutuhannya. Bila koneksi putus di tengah file,
+# transfer dilanjutkan dari byte terakhir (REST/Range) dengan jeda yang berlipat dua, bukan
+# diulang dari nol. Hasilnya harus sama besar dengan SIZE di server dan lolos pemeriksaan
+# struktur PNG sebelum dipublikasikan ke cache. Semua percobaan berbagi satu batas waktu.
+TRANSFER_ATTEMPTS = int(os.getenv("DPI_TRANSFER_ATTEMPTS", "4"))
+TRANSFER_RETRY_DELAY = float(os.getenv("DPI_TRANSFER_RETRY_DELAY", "1"))
+TRANSFER_DEADLINE = float(os.getenv("DPI_TRANSFER_DEADLINE", str(FTP_TIMEOUT * 2)))
+TRANSFER_VERIFY_PNG = os.getenv("DPI_TRANSFER_VERIFY_PNG", "1") == "1"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+# Signature, IHDR sebagai chunk pertama, CRC setiap chunk, dan IEND di akhir
+def check_png(f):
+    f.seek(0)
+    if f.read(8) != PNG_SIGNATURE:
+        raise CorruptDownload("signature PNG tidak valid")
+    first = True
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise CorruptDownload("PNG terpotong sebelum IEND")
+        length, tag = struct.unpack(">I4s", header)
+        if first and tag != b"IHDR":
+            raise CorruptDownload("chunk pertama PNG bukan IHDR")
+        first = False
+        crc = zlib.crc32(tag)
+        remaining = length
+        while remaining:
+            data = f.read(min(remaining, SOURCE_CHUNK_SIZE))
+            if not data:
+                raise CorruptDownload(f"PNG terpotong di chunk {tag.decode('latin-1')}")
+            crc = zlib.crc32(data, crc)
+            remaining -= len(data)
+        stored = f.read(4)
+        if len(stored) < 4 or int.from_bytes(stored, "big") != crc:
+            raise CorruptDownload(f"CRC chunk {tag.decode('latin-1')} tidak cocok")
+        if tag == b"IEND":
+            return
+
+
+def restart_transfer(f):
+    f.seek(0)
+    f.truncate()
+    return 0
+
+
+# Isi f (file .part dari DpiCache.store, mungkin sudah berisi sebagian data) sampai utuh.
+# Mengembalikan (modify, size) dari server untuk revalidasi berikutnya.
+def fetch_image(source, name, f, cancel_event=None):
+    remote = source.stat(name) or (None, None)
+    expected = remote[1]
+    offset = f.tell()
+    if offset and (not source.resumable or (expected is not None and offset > expected)):
+        offset = restart_transfer(f)
+    if offset:
+        logger.info("Melanjutkan transfer %s dari byte %s", name, offset)
+    resumed = offset > 0
+    error = None
+    deadline = time.monotonic() + TRANSFER_DEADLINE
+    for attempt in range(TRANSFER_ATTEMPTS):
+        if attempt:
+            delay = TRANSFER_RETRY_DELAY * 2 ** (attempt - 1)
+            if time.monotonic() + delay >= deadline:
+                logger.info("Transfer %s melewati batas waktu %g detik setelah %s percobaan", name, TRANSFER_DEADLINE, attempt)
+                raise error
+            if cancel_event is not None and cancel_event.wait(delay):
+                raise DownloadCancelled(f"Unduhan {name} dibatalkan")
+            if cancel_event is None:
+                time.sleep(delay)
+        start_offset = offset
+        try:
+            source.retrieve(name, f, cancel_event, offset)
+        except ftplib.error_perm as e:
+            # REST ditolak server: ulang dari awal
+            if offset and str(e)[:3] in ("500", "501", "502", "504"):
+                TRANSFER_RETRIES.inc(reason="rest_unsupported")
+                offset = restart_transfer(f)
+                error = e
+                continue
+            raise
+        except (FileNotFoundError, PermissionError):
+            raise
+        except FTP_CONNECTION_ERRORS as e:
+            offset = f.seek(0, os.SEEK_END)
+            # Timeout tanpa satu byte pun: server macet, mencoba lagi hanya melipatgandakan waktu tunggu
+            if isinstance(e, TimeoutError) and offset == start_offset:
+                raise
+            resumed = resumed or offset > 0
+            TRANSFER_RETRIES.inc(reason="disconnect")
+            logger.info("Transfer %s terputus setelah %s byte (%r), percobaan %s/%s", name, offset, e, attempt + 1, TRANSFER_ATTEMPTS)
+            error = e
+            continue
+        # seek juga menyinkronkan posisi setelah sendfile() menulis langsung ke descriptor
+        offset = f.seek(0, os.SEEK_END)
+        if expected is not None and offset != expected:
+            # Server menjawab "selesai" padahal data kurang; file yang lebih besar berarti berubah
+            TRANSFER_RETRIES.inc(reason="short" if offset < expected else "oversize")
+            logger.info("Transfer %s berisi %s dari %s byte, percobaan %s/%s", name, offset, expected, attempt + 1, TRANSFER_ATTEMPTS)
+            if offset > expected:
+                offset = restart_transfer(f)
+            resumed = resumed or offset > 0
+            error = EOFError(f"{name}: hanya {offset} dari {expected} byte diterima")
+            continue
+        if TRANSFER_VERIFY_PNG:
+            try:
+                check_png(f)
+            except CorruptDownload as e:
+                # Sambungan dengan sisa .part dari versi file sebelumnya bisa rusak: ulang dari awal
+                if not resumed:
+                    raise CorruptDownload(f"{name}: {e}") from None
+                TRANSFER_RETRIES.inc(reason="corrupt")
+                logger.info("%s rusak setelah disambung (%s), diulang dari awal", name, e)
+                offset = restart_transfer(f)
+                resumed = False
+                error = e
+                continue
+        return remote
+    raise error
+
+
+# File yang memang belum ada di sumber gambar (FTP 550, file lokal atau HTTP 404/410)
+def is_missing_file(error):
+    return isinstance(error, FileNotFoundError) or (isinstance(error, ftplib.error_perm) and str(error)[:3] == "550")
+
+
+# Fungsi untuk mengambil satu file (peta atau tabel) dari sumber gambar (default FTP server).
+# Peta dan tabel diunduh sebagai dua tugas terpisah sehingga berjalan bersamaan
+# di koneksi pool yang berbeda, dan kegagalan satu file tidak menyembunyikan yang lain.
+def download_from_ftp(kind, area, selected_date, cancel_event=None, background=False):
+    date_str = selected_date.strftime("%Y%m%d")
+
+    fields = {"kind": kind, "area": area, "date": date_str}
+
+    # Ambil dari cache lebih dulu
+    path = dpi_cache.get(kind, area, date_str)
+    if path is not None:
+        logger.debug("Cache hit untuk %s area: %s, tanggal: %s", kind, area, date_str, extra=fields)
+        revalidate(kind, area, date_str)
+        return {"path": path, "error": None}
+
+    # Transfer dihentikan di tengah jalan bila sesi sudah tidak membutuhkan file ini
+    name = dpi_filename(kind, area, date_str)
+    start = time.perf_counter()
+    try:
+        logger.debug("Mengunduh %s dari: %s", kind, image_source.describe(name), extra=fields)
+        remote = []
+        path = dpi_cache.store(
+            kind, area, date_str,
+            lambda f: remote.append(fetch_image(image_source, name, f, cancel_event)),
+            replace=False,
+        )
+        if remote:
+            revalidator.remember((kind, area, date_str), remote[0])
+        FETCH_SECONDS.observe(time.perf_counter() - start, kind=kind, result="ok")
+        logger.debug("%s berhasil diunduh ke: %s", kind.capitalize(), path, extra=fields)
+        return {"path": path, "error": None}
+    except DownloadCancelled:
+        FETCH_SECONDS.observe(time.perf_counter() - start, kind=kind, result="cancelled")
+        logger.debug("Unduhan %s dibatalkan untuk area: %s, tanggal: %s", kind, area, date_str, extra=fields)
+        raise
+    except Exception as e:
+        FETCH_SECONDS.observe(time.perf_counter() - start, kind=kind, result="error")
+        # File yang tidak ada wajar untuk unduhan spekulatif (prefetch), jadi hanya dicatat di level debug
+        level = logging.DEBUG if background and is_missing_file(e) else logging.ERROR
+        logger.log(level, "Error saat mengunduh %s: %s", kind, e, extra=fields)
+        return {"path": None, "error": FILE_UNAVAILABLE if is_missing_file(e) else FETCH_FAILED}
+
+
+# Hasil per file dari sebuah flight yang sudah selesai
+def flight_result(flight):
+    if flight.future.cancelled():
+        return {"path": None, "error": "dibatalkan"}
+    if flight.future.exception() is not None:
+        logger.error("Unduhan %s gagal: %s", flight.key, flight.future.exception())
+        return {"path": None, "error": FETCH_FAILED}
+    return flight.future.result()
+
+
+# Single-flight: permintaan yang sama (jenis, area, tanggal) dari banyak sesi menunggu satu unduhan.
+# Kegagalan juga dibagikan dan disimpan sebentar (negative cache) agar tidak terjadi badai retry:
+# file yang tidak ada selama FTP_NEGATIVE_TTL, gangguan sementara (timeout, koneksi putus) hanya
+# selama FTP_TRANSIENT_TTL agar pulih segera setelah server kembali.
+FTP_NEGATIVE_TTL = float(os.getenv("FTP_NEGATIVE_TTL", "30"))
+FTP_TRANSIENT_TTL = float(os.getenv("FTP_TRANSIENT_TTL", "3"))
+
+
+class Flight:
+    def __init__(self, key, future, cancel_event, fn=None, background=False):
+        self.key = key
+        self.future = future
+        self.cancel_event = cancel_event
+        self.fn = fn
+        self.background = background
+        self.started = False
+        self.waiters = 0
+
+
+# Flight latar belakang dijalankan di background_executor. Bila pengguna meminta file yang
+# sama sebelum flight itu mulai, flight dipindahkan ke executor utama; thread mana pun yang
+# lebih dulu mengambilnya yang menjalankan fn.
+class SingleFlight:
+    def __init__(self, executor, negative_ttl, background_executor=None, transient_ttl=0):
+        self.executor = executor
+        self.background_executor = background_executor or executor
+        self.negative_ttl = negative_ttl
+        self.transient_ttl = transient_ttl
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._failures = {}
+
+    def _run(self, flight):
+        with self._lock:
+            if flight.started:
+                return
+            flight.started = True
+        if not flight.future.set_running_or_notify_cancel():
+            return
+        try:
+            result = flight.fn(flight.cancel_event)
+        except BaseException as e:
+            flight.future.set_exception(e)
+        else:
+            flight.future.set_result(result)
+
+    def join(self, key, fn, background=False):
+        with self._lock:
+            failure = self._failures.get(key)
+            if failure is not None:
+                expires, result = failure
+                if time.monotonic() < expires:
+                    logger.debug("Negative cache hit untuk %s", key)
+                    future = Future()
+                    future.set_result(result)
+                    return Flight(key, future, threading.Event())
+                del self._failures[key]
+            flight = self._inflight.get(key)
+            created = flight is None
+            promoted = False
+            if created:
+                flight = Flight(key, Future(), threading.Event(), fn, background)
+                self._inflight[key] = flight
+            else:
+                logger.debug("Bergabung dengan unduhan yang sedang berjalan untuk %s", key)
+                promoted = flight.background and not background and not flight.started
+                if promoted:
+                    flight.background = False
+            flight.waiters += 1
+        # Didaftarkan di luar lock: jika future sudah selesai, callback langsung dijalankan di thread ini
+        if created:
+            flight.future.add_done_callback(lambda future: self._finish(flight))
+            (self.background_executor if background else self.executor).submit(self._run, flight)
+        elif promoted:
+            logger.debug("Unduhan latar belakang %s dipindahkan ke antrean utama", key)
+            self.executor.submit(self._run, flight)
+        return flight
+
+    # Dipanggil saat peminta tidak lagi menunggu; unduhan hanya dibatalkan jika tidak ada peminta lain
+    def leave(self, flight):
+        with self._lock:
+            if flight.waiters == 0:
+                return
+            flight.waiters -= 1
+            abandon = flight.waiters == 0 and not flight.future.done()
+            if abandon:
+                flight.cancel_event.set()
+                if self._inflight.get(flight.key) is flight:
+                    del self._inflight[flight.key]
+        # Dibatalkan di luar lock: future yang masih antre langsung menjalankan _finish di thread ini
+        if abandon:
+            flight.future.cancel()
+
+    def _finish(self, flight):
+        with self._lock:
+            if self._inflight.get(flight.key) is flight:
+                del self._inflight[flight.key]
+            if flight.future.cancelled() or flight.future.exception() is not None:
+                return
+            result = flight.future.result()
+            if not result.get("error"):
+                return
+            ttl = self.negative_ttl if is_missing_result(result) else self.transient_ttl
+            if ttl > 0:
+                self._failures[flight.key] = (time.monotonic() + ttl, result)
+
+
+ftp_flights = SingleFlight(ftp_executor, FTP_NEGATIVE_TTL, background_executor, FTP_TRANSIENT_TTL)
+metrics.gauge("dpi_inflight_fetches", "Unduhan file yang sedang berjalan (setelah digabung single-flight)", function=lambda: len(ftp_flights._inflight))
+
+
+def join_download(kind, area, selected_date, background=False):
+    key = (kind, area, selected_date.strftime("%Y%m%d"))
+    return ftp_flights.join(
+        key, lambda cancel_event: download_from_ftp(kind, area, selected_date, cancel_event, background), background=background
+    )
+
+
+# Panggil callback sekali setelah semua flight selesai
+def when_all(flights, callback):
+    remaining = [len(flights)]
+    lock = threading.Lock()
+
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            callback()
+
+    for flight in flights:
+        flight.future.add_done_callback(done)
+
+
+# Isi cache untuk semua area pada tanggal tertentu (dijalankan di executor latar belakang)
+def warm_cache(dates=None):
+    dates = dates or [datetime.now().date()]
+    for date in dates:
+        for area in AREAS:
+            for kind in KINDS:
+                flight = join_download(kind, area, date, background=True)
+                flight.future.add_done_callback(lambda future, flight=flight: ftp_flights.leave(flight))
+    logger.debug("Pemanasan cache dijadwalkan untuk %s area, %s tanggal", len(AREAS), len(dates))
+
+
+# Prefetcher latar belakang: unduh peta dan tabel semua area untuk jendela tanggal tertentu
+# (default hari ini dan besok) ke cache sebelum pengguna memintanya.
+PREFETCH_ENABLED = os.getenv("DPI_PREFETCH", "1") == "1"
+PREFETCH_DAYS_BEFORE = int(os.getenv("DPI_PREFETCH_DAYS_BEFORE", "0"))
+PREFETCH_DAYS_AFTER = int(os.getenv("DPI_PREFETCH_DAYS_AFTER", "1"))
+PREFETCH_INTERVAL = float(os.getenv("DPI_PREFETCH_INTERVAL", "600"))
+PREFETCH_CONCURRENCY = int(os.getenv("DPI_PREFETCH_CONCURRENCY", "2"))
+PREFETCH_BACKOFF_BASE = float(os.getenv("DPI_PREFETCH_BACKOFF_BASE", "30"))
+PREFETCH_BACKOFF_MAX = float(os.getenv("DPI_PREFETCH_BACKOFF_MAX", "1800"))
+
+
+class Prefetcher:
+    def __init__(self, areas, days_before, days_after, interval, concurrency, backoff_base, backoff_max, tick=5, leader=None):
+        self.areas = areas
+        self.leader = leader
+        self.days_before = days_before
+        self.days_after = days_after
+        self.interval = interval
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.tick = tick
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._state = {}
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def window(self):
+        today = datetime.now().date()
+        return [today + timedelta(days=offset) for offset in range(-self.days_before, self.days_after + 1)]
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="dpi-prefetch", daemon=True)
+        self._thread.start()
+        logger.debug("Prefetcher dimulai untuk %s area, %s tanggal", len(self.areas), len(self.window()))
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Di mode multi-worker hanya satu worker yang melakukan prefetch
+            if self.leader is not None and not self.leader.acquire():
+                self._stop.wait(self.tick)
+                continue
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error("Error pada prefetcher: %s", e)
+            # Bangun lebih awal jika ada slot yang kosong
+            self._wake.wait(self.tick)
+            self._wake.clear()
+
+    def run_once(self):
+        now = time.time()
+        keys = [(area, date) for date in self.window() for area in self.areas]
+        with self._lock:
+            # Tanggal yang sudah keluar dari jendela tidak dilacak lagi
+            for key in list(self._state):
+                if key not in keys:
+                    del self._state[key]
+            due = []
+            for key in keys:
+                state = self._state.setdefault(key, {
+                    "status": "pending", "fetched_at": None, "checked_at": None,
+                    "attempts": 0, "next_attempt": 0, "error": None, "running": False,
+                })
+                if not state["running"] and state["next_attempt"] <= now:
+                    due.append((state["next_attempt"], key))
+        # Yang paling lama menunggu didahulukan
+        for _, (area, date) in sorted(due):
+            if self._stop.is_set() or not self._slots.acquire(blocking=False):
+                break
+            with self._lock:
+                self._state[(area, date)]["running"] = True
+            flights = {kind: join_download(kind, area, date, background=True) for kind in KINDS}
+            when_all(list(flights.values()), lambda key=(area, date), flights=flights: self._done(key, flights))
+
+    def _done(self, key, flights):
+        for flight in flights.values():
+            ftp_flights.leave(flight)
+        self._slots.release()
+        self._wake.set()
+        now = time.time()
+        results = {kind: flight_result(flight) for kind, flight in flights.items()}
+        errors = [f"{kind}: {result['error']}" for kind, result in results.items() if result["error"]]
+        result = {"error": "; ".join(errors) or None}
+        with self._lock:
+            state = self._state.get(key)
+            if state is None:
+                return
+            state["running"] = False
+            state["checked_at"] = now
+            if result.get("error"):
+                # Coba lagi dengan backoff eksponensial
+                state["attempts"] += 1
+                state["status"] = "error"
+                state["error"] = result["error"]
+                delay = min(self.backoff_base * 2 ** (state["attempts"] - 1), self.backoff_max)
+                state["next_attempt"] = now + delay
+                logger.debug("Prefetch gagal untuk %s %s, dicoba lagi dalam %.0f detik: %s", key[0], key[1], delay, result['error'])
+            else:
+                try:
+                    fetched_at = min(os.path.getmtime(results[kind]["path"]) for kind in KINDS)
+                except OSError as e:
+                    # File sudah dibuang dari cache sebelum sempat dicatat; dicoba lagi pada putaran berikutnya
+                    logger.debug("Prefetch %s %s dilewati: %s", key[0], key[1], e)
+                    return
+                state["attempts"] = 0
+                state["status"] = "fresh"
+                state["error"] = None
+                state["fetched_at"] = fetched_at
+                state["next_attempt"] = now + self.interval
+
+    # Ringkasan kesegaran cache per area, untuk dipantau lewat route /prefetch
+    def status(self):
+        now = time.time()
+        report = {}
+        with self._lock:
+            for (area, date), state in sorted(self._state.items()):
+                report.setdefault(area, {})[date.strftime("%Y%m%d")] = {
+                    "status": "running" if state["running"] else state["status"],
+                    "age_seconds": round(now - state["fetched_at"]) if state["fetched_at"] else None,
+                    "attempts": state["attempts"],
+                    "next_attempt_in": max(0, round(state["next_attempt"] - now)),
+                    "error": state["error"],
+                }
+        return report
+
+
+prefetcher = Prefetcher(
+    AREAS, PREFETCH_DAYS_BEFORE, PREFETCH_DAYS_AFTER, PREFETCH_INTERVAL,
+    PREFETCH_CONCURRENCY, PREFETCH_BACKOFF_BASE, PREFETCH_BACKOFF_MAX,
+    leader=background_leader,
+)
+
+
+# Indeks ketersediaan: file DPI apa saja yang ada di sumber gambar, dari satu listing
+# (untuk FTP: MLSD, atau NLST bila tidak didukung) per refresh, bukan dari percobaan per file.
+# Disimpan di memori dan di disk; refresh dilewati bila waktu modifikasi direktori (MLST)
+# tidak berubah, dan hanya selisih listing yang diterapkan ke indeks.
+AVAILABILITY_ENABLED = os.getenv("DPI_AVAILABILITY", "1") == "1"
+AVAILABILITY_INTERVAL = float(os.getenv("DPI_AVAILABILITY_INTERVAL", "300"))
+AVAILABILITY_MAX_AGE = float(os.getenv("DPI_AVAILABILITY_MAX_AGE", str(AVAILABILITY_INTERVAL * 4)))
+AVAILABILITY_POLL_INTERVAL = float(os.getenv("DPI_AVAILABILITY_POLL_INTERVAL", "10"))
+AVAILABILITY_PATH = os.getenv("DPI_AVAILABILITY_PATH", os.path.join(CACHE_DIR, "availability.json"))
+
+
+class AvailabilityIndex:
+    def __init__(self, source, interval, max_age, path, leader=None, follow_interval=None):
+        self.source = source
+        self.leader = leader
+        self.follow_interval = follow_interval or interval
+        self.interval = interval
+        self.max_age = max_age
+        self.path = path
+        self.version = 0
+        self.refreshed_at = None
+        self.error = None
+        self._lock = threading.Lock()
+        self._files = {}
+        self._dates = {}
+        self._directory_modify = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _add(self, name):
+        key = dpi_key(name)
+        if key is None:
+            return
+        kind, area, date_str = key
+        self._dates.setdefault(area, {}).setdefault(date_str, set()).add(kind)
+
+    def _discard(self, name):
+        key = dpi_key(name)
+        if key is None:
+            return
+        kind, area, date_str = key
+        kinds = self._dates.get(area, {}).get(date_str)
+        if kinds is not None:
+            kinds.discard(kind)
+            if not kinds:
+                del self._dates[area][date_str]
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error("Indeks ketersediaan di disk tidak dapat dibaca: %s", e)
+            return
+        with self._lock:
+            self._directory_modify = data.get("directory_modify")
+            self.refreshed_at = data.get("refreshed_at")
+            files = data.get("files", {})
+            if files.keys() == self._files.keys():
+                return
+            self._files = files
+            self._dates = {}
+            for name in self._files:
+                self._add(name)
+            self.version += 1
+        logger.debug("Indeks ketersediaan dimuat dari disk: %s file", len(self._files))
+
+    def _save(self):
+        with self._lock:
+            data = {"refreshed_at": self.refreshed_at, "directory_modify": self._directory_modify, "files": dict(self._files)}
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".availability.", suffix=".part")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def refresh(self):
+        modify = self.source.modified()
+        with self._lock:
+            # Resolusi MLST hanya per detik: perubahan pada detik yang sama dengan listing
+            # sebelumnya tidak terlihat, jadi listing hanya dilewati bila modify jelas lebih lama
+            unchanged = (
+                modify is not None and modify == self._directory_modify and self.refreshed_at is not None
+                and modify_timestamp(modify) < self.refreshed_at - 1
+            )
+        if unchanged:
+            with self._lock:
+                self.refreshed_at = time.time()
+                self.error = None
+            logger.debug("Direktori FTP tidak berubah, listing dilewati")
+            self._save()
+            return
+        files = self.source.listdir()
+        if files is None:
+            logger.debug("Sumber gambar tidak mendukung listing, indeks ketersediaan tidak diperbarui")
+            return
+        with self._lock:
+            added = [name for name in files if name not in self._files]
+            removed = [name for name in self._files if name not in files]
+            for name in removed:
+                self._discard(name)
+            for name in added:
+                self._add(name)
+            self._files = files
+            self._directory_modify = modify
+            self.refreshed_at = time.time()
+            self.error = None
+            if added or removed:
+                self.version += 1
+        logger.debug("Indeks ketersediaan diperbarui: %s file baru, %s file hilang, total %s", len(added), len(removed), len(files))
+        self._save()
+
+    # Dipanggil oleh cache disk setiap kali file berhasil diunduh
+    def mark_available(self, kind, area, date_str):
+        name = dpi_filename(kind, area, date_str)
+        with self._lock:
+            if name in self._files:
+                return
+            self._files[name] = None
+            self._add(name)
+            self.version += 1
+
+    def fresh(self):
+        return self.refreshed_at is not None and time.time() - self.refreshed_at <= self.max_age
+
+    # Tanggal sebelum hari listing yang tidak ada di indeks pasti tidak tersedia; tanggal
+    # sesudahnya masih mungkin diunggah di antara dua refresh sehingga tidak dianggap hilang
+    def known_before(self):
+        if not self.fresh():
+            return None
+        return datetime.fromtimestamp(self.refreshed_at).date()
+
+    def listed(self, area, selected_date, kind):
+        with self._lock:
+            return kind in self._dates.get(area, {}).get(selected_date.strftime("%Y%m%d"), ())
+
+    def known_missing(self, area, selected_date, kinds=KINDS):
+        known_before = self.known_before()
+        if known_before is None or selected_date >= known_before:
+            return False
+        with self._lock:
+            listed = self._dates.get(area, {}).get(selected_date.strftime("%Y%m%d"), set())
+            return not all(kind in listed for kind in kinds)
+
+    # Tanggal yang punya setidaknya satu file, beserta jenis file yang ada: {"YYYYMMDD": ["peta", ...]}
+    def available_dates(self, area):
+        with self._lock:
+            dates = self._dates.get(area, {})
+            return {date_str: [kind for kind in KINDS if kind in kinds] for date_str, kinds in sorted(dates.items()) if kinds}
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="dpi-availability", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                # Di mode multi-worker hanya satu worker yang melakukan listing; worker lain
+                # membaca indeks yang disimpannya di disk
+                if self.leader is None or self.leader.acquire():
+                    self.refresh()
+                    wait = self.interval
+                else:
+                    self.load()
+                    wait = self.follow_interval
+            except Exception as e:
+                self.error = str(e)
+                wait = self.interval
+                logger.error("Error saat memperbarui indeks ketersediaan: %s", e)
+            self._stop.wait(wait)
 
-# Fungsi untuk mengambil file dari FTP server
-def download_from_ftp(area, selected_date):
+    def status(self):
+        with self._lock:
+            return {
+                "files": len(self._files),
+                "age_seconds": round(time.time() - self.refreshed_at) if self.refreshed_at else None,
+                "fresh": self.fresh(),
+                "version": self.version,
+                "error": self.error,
+            }
+
+
+availability_index = AvailabilityIndex(
+    image_source, AVAILABILITY_INTERVAL, AVAILABILITY_MAX_AGE, AVAILABILITY_PATH,
+    leader=background_leader, follow_interval=AVAILABILITY_POLL_INTERVAL,
+)
+metrics.gauge(
+    "dpi_availability_age_seconds", "Umur indeks ketersediaan sejak refresh terakhir",
+    function=lambda: {(): time.time() - availability_index.refreshed_at} if availability_index.refreshed_at else {}
+)
+if AVAILABILITY_ENABLED:
+    availability_index.load()
+dpi_cache.listeners.append(availability_index.mark_available)
+
+
+# Stale-while-revalidate: file di cache langsung dipakai, lalu diperiksa di latar belakang
+# dengan perintah murah (MDTM/SIZE di FTP, HEAD di HTTP), paling sering sekali per interval
+# per file. File hanya diunduh ulang bila berubah di server (misalnya prakiraan dikoreksi),
+# dan sesi yang sedang melihat file itu merender ulang gambarnya.
+REVALIDATE_ENABLED = os.getenv("DPI_REVALIDATE", "1") == "1"
+REVALIDATE_INTERVAL = float(os.getenv("DPI_REVALIDATE_INTERVAL", "300"))
+REVALIDATE_CONCURRENCY = int(os.getenv("DPI_REVALIDATE_CONCURRENCY", "1"))
+REVALIDATE_POLL_INTERVAL = float(os.getenv("DPI_REVALIDATE_POLL_INTERVAL", "5"))
+# Berapa lama catatan file yang diunduh ulang disimpan untuk sesi yang belum mengeceknya
+REVALIDATE_HISTORY = max(60.0, REVALIDATE_POLL_INTERVAL * 10)
+# Jumlah maksimum MDTM/SIZE yang diingat (LRU); file yang sudah dihapus dari cache dilupakan
+REVALIDATE_MAX_ENTRIES = int(os.getenv("DPI_REVALIDATE_MAX_ENTRIES", "10000"))
+
+
+class Revalidator:
+    def __init__(self, cache, source, interval, concurrency, history=REVALIDATE_HISTORY, max_entries=REVALIDATE_MAX_ENTRIES):
+        self.cache = cache
+        self.source = source
+        self.interval = interval
+        self.history = history
+        self.max_entries = max_entries
+        self.version = 0
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="dpi-revalidate")
+        self._lock = threading.Lock()
+        self._checked = {}
+        self._pending = set()
+        self._validators = OrderedDict()
+        self._refreshed = {}
+        self.checks = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    # Dipanggil setiap kali file dilayani dari cache; pemeriksaan dijadwalkan bila sudah waktunya
+    def touch(self, kind, area, date_str):
+        key = (kind, area, date_str)
+        now = time.monotonic()
+        with self._lock:
+            if key in self._pending or now - self._checked.get(key, -self.interval) < self.interval:
+                return
+            self._pending.add(key)
+            self._checked[key] = now
+        self._executor.submit(self._check, key)
+
+    # Salinan lokal dianggap basi bila ukurannya berbeda, atau bila file di server diubah setelah
+    # salinan ini diunduh (mtime file cache = waktu unduh). Setelah pemeriksaan pertama,
+    # nilai MDTM/SIZE dari server disimpan dan dibandingkan langsung.
+    def _changed(self, key, stat, remote):
+        modify, size = remote
+        with self._lock:
+            known = self._validators.get(key)
+        if known is not None:
+            return any(new is not None and old is not None and new != old for new, old in zip(remote, known))
+        if size is not None and size != stat.st_size:
+            return True
+        return modify is not None and modify_timestamp(modify) > stat.st_mtime
+
+    def _check(self, key):
+        kind, area, date_str = key
+        fields = {"kind": kind, "area": area, "date": date_str}
+        name = dpi_filename(kind, area, date_str)
+        try:
+            try:
+                stat = os.stat(self.cache.path(kind, area, date_str))
+            except FileNotFoundError:
+                # Sudah dihapus dari cache (eviksi): nilai validator lamanya tidak dipakai lagi
+                with self._lock:
+                    self._validators.pop(key, None)
+                return
+            remote = self.source.stat(name)
+            with self._lock:
+                self.checks += 1
+            if remote is None or remote == (None, None):
+                REVALIDATIONS.inc(result="unknown")
+                return
+            if not self._changed(key, stat, remote):
+                self.remember(key, remote)
+                REVALIDATIONS.inc(result="unchanged")
+                return
+            logger.info("%s berubah di server (modify %s, size %s), mengunduh ulang", name, remote[0], remote[1], extra=fields)
+            self.cache.store(kind, area, date_str, lambda f: fetch_image(self.source, name, f))
+            self.remember(key, remote)
+            with self._lock:
+                self.refreshes += 1
+                self.version += 1
+                self._refreshed[key] = (self.version, time.monotonic())
+            REVALIDATIONS.inc(result="changed")
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            REVALIDATIONS.inc(result="error")
+            logger.warning("Revalidasi %s gagal, salinan di cache tetap dipakai: %s", name, e, extra=fields)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+                self._prune(time.monotonic())
+
+    # Buang catatan yang sudah tidak berpengaruh: jadwal pemeriksaan yang sudah lewat interval
+    # dan file diunduh ulang yang lebih lama dari history (sesi mengecek setiap beberapa detik)
+    def _prune(self, now):
+        self._checked = {key: checked for key, checked in self._checked.items() if now - checked < self.interval}
+        self._refreshed = {key: item for key, item in self._refreshed.items() if now - item[1] < self.history}
+
+    # MDTM/SIZE dari server saat file diunduh, agar pemeriksaan berikutnya bisa dibandingkan langsung
+    def remember(self, key, remote):
+        if remote is None or remote == (None, None):
+            return
+        with self._lock:
+            self._validators[key] = remote
+            self._validators.move_to_end(key)
+            while len(self._validators) > self.max_entries:
+                self._validators.popitem(last=False)
+
+    # Kunci yang diunduh ulang setelah versi tertentu, untuk sesi yang memeriksa perubahan
+    def refreshed_since(self, version):
+        with self._lock:
+            return {key for key, (refreshed, _) in self._refreshed.items() if refreshed > version}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": REVALIDATE_ENABLED,
+                "interval": self.interval,
+                "checks": self.checks,
+                "refreshes": self.refreshes,
+                "errors": self.errors,
+                "pending": len(self._pending),
+                "validators": len(self._validators),
+            }
+
+
+revalidator = Revalidator(dpi_cache, image_source, REVALIDATE_INTERVAL, REVALIDATE_CONCURRENCY)
+
+
+def revalidate(kind, area, date_str):
+    if REVALIDATE_ENABLED:
+        revalidator.touch(kind, area, date_str)
+
+
+# Pesan error yang ditampilkan ke pengguna; detail (path, exception) hanya dicatat di log
+FILE_UNAVAILABLE = "File tidak tersedia di server FTP"
+FETCH_FAILED = "Terjadi kesalahan saat mengambil file. Silakan coba lagi nanti."
+# Hasil untuk file yang menurut indeks tidak ada; satu objek dipakai bersama semua sesi
+UNAVAILABLE_RESULT = {"path": None, "error": FILE_UNAVAILABLE}
+
+
+# Hasil unduhan untuk file yang memang tidak ada di sumber (bukan gangguan sementara)
+def is_missing_result(result):
+    return result["path"] is None and result["error"] in (None, FILE_UNAVAILABLE)
+
+
+# Jalankan download_from_ftp di thread pool agar event loop tidak terblokir.
+# Jika task dibatalkan (area/tanggal berganti) dan tidak ada sesi lain yang menunggu
+# unduhan yang sama, transfer yang sedang berjalan ikut dihentikan.
+async def download_file_async(kind, area, selected_date, background=False):
     date_str = selected_date.strftime("%Y%m%d")
-    ftp_url = os.getenv("FTP_URL", "isisendiri")
-    username = os.getenv("FTP_USERNAME", "isisendiri")
-    password = os.getenv("FTP_PASSWORD", "isisendiri")
-    base_path = "your_data"
-    peta_filename = f"peta_dpi_{area}_{date_str}.png"
-    tabel_filename = f"tabel_dpi_{area}_{date_str}.png"
-    peta_path = f"{base_path}/{peta_filename}"
-    tabel_path = f"{base_path}/{tabel_filename}"
-    logger.debug(f"Mengunduh peta dari: ftp://{ftp_url}{peta_path}")
-    logger.debug(f"Mengunduh tabel dari: ftp://{ftp_url}{tabel_path}")
-    
-    temp_dir = os.path.join(tempfile.gettempdir(), "dpi_images")
-    if os.path.exists(temp_dir):
-        shutil.rmtree(temp_dir)
-    os.makedirs(temp_dir, exist_ok=True)
-      
-    local_peta_path = os.path.join(temp_dir, peta_filename)
-    local_tabel_path = os.path.join(temp_dir, tabel_filename)
-      
+    path = await asyncio.to_thread(dpi_cache.get, kind, area, date_str)
+    if path is not None:
+        revalidate(kind, area, date_str)
+        return {"path": path, "error": None}
+    if availability_index.known_missing(area, selected_date, [kind]):
+        return UNAVAILABLE_RESULT
+    flight = join_download(kind, area, selected_date, background)
+    waiter = asyncio.wrap_future(flight.future)
     try:
-        with ftplib.FTP(ftp_url, username, password, timeout=60) as ftp:
-            ftp.set_pasv(False)
-            with open(local_peta_path, "wb") as f:
-                ftp.retrbinary(f"RETR {peta_path}", f.write)
-            logger.debug(f"Peta berhasil diunduh ke: {local_peta_path}")
-            with open(local_tabel_path, "wb") as f:
-                ftp.retrbinary(f"RETR {tabel_path}", f.write)
-            logger.debug(f"Tabel berhasil diunduh ke: {local_tabel_path}")
-        return {"peta": local_peta_path, "tabel": local_tabel_path, "error": None}
-    except Exception as e:
-        logger.error(f"Error saat mengunduh file: {str(e)}")
-        return {"peta": None, "tabel": None, "error": f"Error downloading files: {str(e)}"}
+        return await asyncio.shield(waiter)
+    finally:
+        ftp_flights.leave(flight)
+        # Hasil unduhan yang ditinggalkan tetap "diambil" agar tidak muncul peringatan asyncio
+        waiter.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+
+# Peta dan tabel diunduh bersamaan; hasilnya per jenis file
+async def download_from_ftp_async(area, selected_date):
+    results = await asyncio.gather(*(download_file_async(kind, area, selected_date) for kind in KINDS))
+    return dict(zip(KINDS, results))
+
+
+# Prefetch spekulatif untuk tanggal di sekitar tanggal yang dipilih (±N hari, yang terdekat dulu).
+# Prioritasnya lebih rendah dari unduhan utama: jumlah unduhan spekulatif di seluruh proses
+# dibatasi (default 1) sehingga sisa thread FTP tetap tersedia untuk permintaan pengguna.
+ADJACENT_PREFETCH_DAYS = int(os.getenv("DPI_ADJACENT_DAYS", "3"))
+ADJACENT_PREFETCH_CONCURRENCY = int(os.getenv("DPI_ADJACENT_CONCURRENCY", "1"))
+adjacent_slots = asyncio.Semaphore(ADJACENT_PREFETCH_CONCURRENCY)
+
+
+# Stream file DPI per potongan; jika belum ada di cache, diunduh dulu lewat single-flight.
+# Memori per unduhan tetap sebesar satu potongan, berapa pun ukuran gambarnya.
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DPI_DOWNLOAD_CHUNK_KB", "64")) * 1024
+
+
+async def stream_dpi_file(kind, area, selected_date):
+    path = dpi_cache.get(kind, area, selected_date.strftime("%Y%m%d"))
+    if path is None:
+        result = await download_file_async(kind, area, selected_date)
+        path = result["path"]
+        if path is None:
+            return
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def adjacent_dates(selected_date, days):
+    dates = []
+    for offset in range(1, days + 1):
+        dates.append(selected_date + timedelta(days=offset))
+        dates.append(selected_date - timedelta(days=offset))
+    return dates
+
+
+# Tanggal setelah hari ini hampir selalu belum diunggah, jadi hanya diambil bila indeks
+# ketersediaan sudah mencatat filenya. Unduhan berjalan di executor latar belakang.
+async def prefetch_adjacent(area, selected_date, days=ADJACENT_PREFETCH_DAYS):
+    today = datetime.now().date()
+    for date in adjacent_dates(selected_date, days):
+        date_str = date.strftime("%Y%m%d")
+        kinds = [
+            kind for kind in KINDS
+            if (date <= today or availability_index.listed(area, date, kind))
+            and not availability_index.known_missing(area, date, [kind])
+            and dpi_cache.get(kind, area, date_str) is None
+        ]
+        if not kinds:
+            continue
+        async with adjacent_slots:
+            results = await asyncio.gather(*(download_file_async(kind, area, date, background=True) for kind in kinds))
+        errors = [f"{kind}: {result['error']}" for kind, result in zip(kinds, results) if result["error"]]
+        logger.debug("Prefetch tanggal sekitar %s %s: %s", area, date_str, '; '.join(errors) or 'ok')
+
+
+# Penyimpanan jumlah unduhan yang persisten dan dipakai bersama oleh semua sesi dan worker.
+# Penambahan dikumpulkan di memori lalu ditulis berkala (write-behind), sehingga mencatat
+# unduhan tidak pernah menunggu disk. Backend dipilih lewat DPI_COUNTER_BACKEND.
+COUNTER_BACKEND = os.getenv("DPI_COUNTER_BACKEND", "sqlite")
+COUNTER_DB_PATH = os.getenv("DPI_COUNTER_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "download_counts.sqlite3"))
+COUNTER_FLUSH_INTERVAL = float(os.getenv("DPI_COUNTER_FLUSH_INTERVAL", "2"))
+COUNTER_CACHE_TTL = float(os.getenv("DPI_COUNTER_CACHE_TTL", "5"))
+
+
+# Antarmuka backend penghitung; backend lain cukup menyediakan method yang sama.
+# open() dipanggil saat aplikasi mulai (lifespan), get() selalu dipanggil di luar event loop.
+class CounterStore(abc.ABC):
+    def open(self):
+        pass
+
+    @abc.abstractmethod
+    def increment(self, kind, key, amount=1):
+        pass
+
+    @abc.abstractmethod
+    def get(self, kind, key):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+# Hanya untuk satu proses (misalnya pengembangan lokal); hilang saat aplikasi dimatikan
+class MemoryCounterStore(CounterStore):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def increment(self, kind, key, amount=1):
+        with self._lock:
+            self._counts[(kind, key)] = self._counts.get((kind, key), 0) + amount
+
+    def get(self, kind, key):
+        with self._lock:
+            return self._counts.get((kind, key), 0)
+
+
+# SQLite mode WAL: penambahan dari banyak proses digabung secara atomik dengan UPSERT
+# di dalam transaksi, pembacaan tidak memblokir penulisan. Koneksi tulis hanya dipakai thread
+# flush; pembacaan memakai koneksi sendiri per thread sehingga tidak pernah menunggu flush.
+class SqliteCounterStore(CounterStore):
+    def __init__(self, path, flush_interval, cache_ttl):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._pending = {}
+        self._cache = {}
+        self._stop = threading.Event()
+        self._db = None
+        self._readers = threading.local()
+        self._reader_connections = []
+        self._thread = None
+
+    # Database baru dibuat saat aplikasi mulai, bukan saat modul diimpor
+    def open(self):
+        if self._db is not None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS download_counts ("
+            "kind TEXT NOT NULL, key TEXT NOT NULL, count INTEGER NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (kind, key))"
+        )
+        self._db = db
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="dpi-counter-flush", daemon=True)
+        self._thread.start()
+
+    def _reader(self):
+        db = getattr(self._readers, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            self._readers.db = db
+            with self._lock:
+                self._reader_connections.append(db)
+        return db
+
+    def increment(self, kind, key, amount=1):
+        with self._lock:
+            self._pending[(kind, key)] = self._pending.get((kind, key), 0) + amount
+
+    def get(self, kind, key):
+        now = time.monotonic()
+        with self._lock:
+            pending = self._pending.get((kind, key), 0)
+            cached = self._cache.get((kind, key))
+        if cached is not None and cached[1] > now:
+            return cached[0] + pending
+        if self._db is None:
+            return (cached[0] if cached else 0) + pending
+        try:
+            row = self._reader().execute(
+                "SELECT count FROM download_counts WHERE kind = ? AND key = ?", (kind, key)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Gagal membaca jumlah unduhan %s %s: %s", kind, key, e)
+            return (cached[0] if cached else 0) + pending
+        value = row[0] if row else 0
+        with self._lock:
+            self._cache[(kind, key)] = (value, now + self.cache_ttl)
+            # Penambahan yang selesai di-flush selama query berjalan sudah termasuk di value
+            pending = self._pending.get((kind, key), 0)
+        return value + pending
+
+    def flush(self):
+        if self._db is None:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            with self._db_lock:
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    self._db.executemany(
+                        "INSERT INTO download_counts (kind, key, count) VALUES (?, ?, ?) "
+                        "ON CONFLICT (kind, key) DO UPDATE SET count = count + excluded.count",
+                        [(kind, key, amount) for (kind, key), amount in pending.items()],
+                    )
+                    self._db.execute("COMMIT")
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+        except Exception as e:
+            logger.error("Gagal menyimpan jumlah unduhan: %s", e)
+            # Kembalikan ke antrean agar dicoba lagi pada flush berikutnya
+            with self._lock:
+                for item, amount in pending.items():
+                    self._pending[item] = self._pending.get(item, 0) + amount
+            return
+        with self._lock:
+            for item, amount in pending.items():
+                cached = self._cache.get(item)
+                if cached is not None:
+                    self._cache[item] = (cached[0] + amount, cached[1])
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+        with self._lock:
+            connections, self._reader_connections = self._reader_connections, []
+        for db in connections:
+            db.close()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def create_counter_store(backend):
+    if backend == "memory":
+        return MemoryCounterStore()
+    if backend == "sqlite":
+        return SqliteCounterStore(COUNTER_DB_PATH, COUNTER_FLUSH_INTERVAL, COUNTER_CACHE_TTL)
+    # Backend lain bisa dipasang dengan format "modul:NamaKelas"
+    module_name, _, attr = backend.partition(":")
+    return getattr(importlib.import_module(module_name), attr)()
+
+
+counter_store = create_counter_store(COUNTER_BACKEND)
+
+
+# Hub pub/sub untuk jumlah unduhan. Setiap unduhan hanya menandai key-nya sebagai berubah;
+# paling sering sekali per interval, jumlah terbaru untuk key itu dibaca sekali lalu dikirim
+# ke semua sesi yang sedang melihat key tersebut. Biayanya O(sesi yang melihat) per interval,
+# bukan O(sesi x unduhan). Key yang dilihat juga dicek ulang berkala untuk menangkap unduhan
+# dari worker lain.
+COUNT_PUSH_INTERVAL = float(os.getenv("DPI_COUNT_PUSH_INTERVAL", "1"))
+COUNT_REFRESH_INTERVAL = float(os.getenv("DPI_COUNT_REFRESH_INTERVAL", "10"))
+
+
+class CountHub:
+    def __init__(self, store, push_interval, refresh_interval):
+        self.store = store
+        self.push_interval = push_interval
+        self.refresh_interval = refresh_interval
+        self._subscribers = {}
+        self._session_keys = {}
+        self._dirty = set()
+        self._last = {}
+        self._task = None
+
+    def subscribe(self, session, key):
+        if self._session_keys.get(session) == key:
+            return
+        self.unsubscribe(session)
+        self._subscribers.setdefault(key, set()).add(session)
+        self._session_keys[session] = key
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def unsubscribe(self, session):
+        key = self._session_keys.pop(session, None)
+        if key is None:
+            return
+        sessions = self._subscribers.get(key)
+        if sessions is not None:
+            sessions.discard(session)
+            if not sessions:
+                del self._subscribers[key]
+                self._last.pop(key, None)
+
+    def publish(self, key):
+        self._dirty.add(key)
+
+    def _read(self, key):
+        return {kind: self.store.get(kind, key) for kind in KINDS}
+
+    async def _run(self):
+        last_refresh = time.monotonic()
+        while self._subscribers:
+            await asyncio.sleep(self.push_interval)
+            keys, self._dirty = self._dirty, set()
+            if time.monotonic() - last_refresh >= self.refresh_interval:
+                keys |= set(self._subscribers)
+                last_refresh = time.monotonic()
+            for key in keys:
+                if not self._subscribers.get(key):
+                    continue
+                counts = await asyncio.to_thread(self._read, key)
+                if counts == self._last.get(key):
+                    continue
+                self._last[key] = counts
+                message = dict(counts, key=key)
+                sessions = list(self._subscribers.get(key, ()))
+                await asyncio.gather(
+                    *(session.send_custom_message("update_download_count", message) for session in sessions),
+                    return_exceptions=True,
+                )
+
+
+count_hub = CountHub(counter_store, COUNT_PUSH_INTERVAL, COUNT_REFRESH_INTERVAL)
+
+
+# Ekspor massal: peta dan tabel untuk banyak area dan rentang tanggal dalam satu ZIP.
+# ZIP ditulis sambil di-stream (tanpa seek, memakai data descriptor), jadi memori per ekspor
+# hanya sebesar satu potongan. File diambil lewat jalur unduhan biasa (cache + single-flight),
+# beberapa sekaligus dan tetap dalam urutan; file yang tidak ada dicatat di status.csv.
+EXPORT_MAX_DAYS = int(os.getenv("DPI_EXPORT_MAX_DAYS", "31"))
+EXPORT_CONCURRENCY = int(os.getenv("DPI_EXPORT_CONCURRENCY", "2"))
+EXPORT_STATUS_COLUMNS = ("area", "tanggal", "jenis", "file", "status", "ukuran_byte")
+
+
+# Kode status pendek untuk status.csv: "ok", "tidak_tersedia", atau "gagal" (detail hanya di log)
+def export_status(result):
+    if result["path"] is not None:
+        return "ok"
+    if is_missing_result(result):
+        return "tidak_tersedia"
+    return "gagal"
+
+
+# Tujuan tulis untuk zipfile yang isinya diambil per potongan (tidak bisa seek)
+class ZipStream:
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def parse_export_request(areas, start, end, kinds=None):
+    areas = [area for area in AREAS if area in set(areas)]
+    if not areas:
+        raise ValueError("Pilih minimal satu area")
+    kinds = [kind for kind in KINDS if kind in set(kinds or KINDS)]
+    if not kinds:
+        raise ValueError("Jenis file tidak dikenal")
+    if isinstance(start, str):
+        start = datetime.strptime(start, "%Y-%m-%d").date()
+    if isinstance(end, str):
+        end = datetime.strptime(end, "%Y-%m-%d").date()
+    if start > end:
+        raise ValueError("Tanggal awal setelah tanggal akhir")
+    days = (end - start).days + 1
+    if days > EXPORT_MAX_DAYS:
+        raise ValueError(f"Rentang tanggal maksimal {EXPORT_MAX_DAYS} hari")
+    dates = [start + timedelta(days=offset) for offset in range(days)]
+    return areas, dates, kinds
+
+
+def export_filename(dates):
+    return f"dpi_{dates[0].strftime('%Y%m%d')}_{dates[-1].strftime('%Y%m%d')}.zip"
+
+
+async def stream_export_zip(areas, dates, kinds=KINDS):
+    entries = [(area, date, kind) for date in dates for area in areas for kind in kinds]
+
+    async def ambil(area, date, kind):
+        try:
+            return await download_file_async(kind, area, date)
+        except Exception as e:
+            logger.error("Ekspor %s %s %s gagal: %s", kind, area, date, e)
+            return {"path": None, "error": FETCH_FAILED}
+
+    sink = ZipStream()
+    status = io.StringIO()
+    writer = csv.writer(status)
+    writer.writerow(EXPORT_STATUS_COLUMNS)
+    pending = deque()
+    index = 0
+    try:
+        with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as zf:
+            while index < len(entries) or pending:
+                # Jendela unduhan: beberapa file diambil di depan, ditulis sesuai urutan
+                while index < len(entries) and len(pending) < EXPORT_CONCURRENCY:
+                    pending.append((entries[index], asyncio.ensure_future(ambil(*entries[index]))))
+                    index += 1
+                (area, date, kind), task = pending.popleft()
+                result = await task
+                date_str = date.strftime("%Y%m%d")
+                name = f"{area}/{dpi_filename(kind, area, date_str)}"
+                if result["path"] is None:
+                    writer.writerow((area, date.isoformat(), kind, name, export_status(result), ""))
+                    continue
+                try:
+                    f = open(result["path"], "rb")
+                except OSError as e:
+                    # File cache bisa terhapus (eviksi) di antara unduhan dan penulisan ZIP
+                    logger.error("Ekspor %s gagal dibaca: %s", name, e)
+                    writer.writerow((area, date.isoformat(), kind, name, "gagal", ""))
+                    continue
+                with f:
+                    stat = os.fstat(f.fileno())
+                    size = stat.st_size
+                    info = zipfile.ZipInfo(name, date_time=time.localtime(stat.st_mtime)[:6])
+                    info.file_size = size
+                    with zf.open(info, "w") as entry:
+                        while True:
+                            chunk = await asyncio.to_thread(f.read, DOWNLOAD_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            entry.write(chunk)
+                            yield sink.drain()
+                    yield sink.drain()
+                writer.writerow((area, date.isoformat(), kind, name, "ok", size))
+                key = f"{area}_{date_str}"
+                counter_store.increment(kind, key)
+                count_hub.publish(key)
+            zf.writestr("status.csv", status.getvalue())
+    finally:
+        for _, task in pending:
+            task.cancel()
+    yield sink.drain()
+
+
+# Laporan memori per sesi untuk perencanaan kapasitas (route /sessions). State satu sesi
+# diukur dengan menelusuri objek milik sesi itu (input, output, dan semua nilai reaktif, effect,
+# output, dan closure yang dibuat server() untuknya; sys.getsizeof). Penelusuran berhenti di
+# objek yang dipakai bersama: modul, kelas, fungsi tingkat modul, variabel global (cache, pool,
+# aplikasi), event loop, dan objek Session. Objek koneksi (uvicorn, asyncio) dihitung tanpa
+# ditelusuri lebih dalam. Selain itu selisih RSS proses sejak sebelum sesi pertama, dikurangi
+# isi cache memori gambar, dibagi jumlah sesi.
+# Penelusuran cukup berat, jadi route hanya aktif bila DPI_SESSION_REPORT_TOKEN diisi dan
+# dijalankan di thread terpisah, satu laporan pada satu waktu.
+SESSION_REPORT_SAMPLE = int(os.getenv("DPI_SESSION_REPORT_SAMPLE", "5"))
+SESSION_REPORT_TOKEN = os.getenv("DPI_SESSION_REPORT_TOKEN", "")
+FOOTPRINT_OPAQUE_MODULES = ("uvicorn", "starlette", "asyncio", "_asyncio", "threading", "concurrent", "websockets", "logging")
+
+active_sessions = weakref.WeakSet()
+session_roots = weakref.WeakKeyDictionary()
+session_report_lock = asyncio.Lock()
+baseline_rss = [None]
+
+
+def process_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def shared_object_ids(sessions, loop):
+    shared = {id(module) for module in list(sys.modules.values())}
+    shared.update(id(vars(module)) for module in list(sys.modules.values()) if hasattr(module, "__dict__"))
+    shared.update(id(value) for value in list(globals().values()))
+    shared.update(id(session) for session in sessions)
+    shared.add(id(loop))
+    return shared
+
+
+def session_footprint(roots, shared):
+    seen = set(shared)
+    stack = list(roots)
+    size = objects = reactive_values = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, (type, types.ModuleType, types.CodeType, types.BuiltinFunctionType)):
+            continue
+        # Fungsi tingkat modul dipakai bersama; closure (fungsi di dalam server()) milik sesi
+        if isinstance(obj, types.FunctionType) and "<locals>" not in obj.__qualname__:
+            continue
+        size += sys.getsizeof(obj)
+        objects += 1
+        if isinstance(obj, reactive.Value):
+            reactive_values += 1
+        if type(obj).__module__.split(".")[0] in FOOTPRINT_OPAQUE_MODULES:
+            continue
+        stack.extend(gc.get_referents(obj))
+    return {"bytes": size, "objects": objects, "reactive_values": reactive_values}
+
+
+# sessions dan roots diambil di event loop; penelusurannya sendiri berjalan di thread lain
+def session_report(sessions, roots, loop):
+    shared = shared_object_ids(sessions, loop)
+    footprints = [session_footprint(owned, shared) for owned in roots]
+    rss = process_rss()
+    report = {
+        "active": len(sessions),
+        "rss_bytes": rss,
+        "baseline_rss_bytes": baseline_rss[0],
+        "rss_per_session_bytes": None,
+        "sampled": len(footprints),
+    }
+    shared = payload_cache.stats()["bytes"]
+    report["shared_cache_bytes"] = shared
+    if sessions and rss is not None and baseline_rss[0] is not None:
+        report["rss_per_session_bytes"] = max(0, rss - baseline_rss[0] - shared) // len(sessions)
+    for field in ("bytes", "objects", "reactive_values"):
+        report[f"state_{field}_per_session"] = (
+            sum(footprint[field] for footprint in footprints) // len(footprints) if footprints else None
+        )
+    return report
 
 
 # CSS dan JavaScript dari kode R
@@ -154,6 +2816,16 @@ body {
 .calendar-date.today {
     border: 1px solid #3c8dbc;
 }
+.calendar-date.unavailable {
+    color: #bbb;
+    cursor: default;
+}
+.calendar-date.unavailable:hover {
+    background-color: transparent;
+}
+.calendar-date.partial {
+    border-bottom: 2px dotted #bbb;
+}
 .calendar-header {
     display: flex;
     justify-content: space-between;
@@ -394,6 +3066,67 @@ app_ui = ui.page_fluid(
         ),
         ui.tags.style(css_styles),
         ui.tags.script("""
+            // Kalender dirender di browser; server hanya mengirim bulan, tahun, dan tanggal terpilih
+            var kalender = {month: null, year: null, selected: null, today: null, available: null, knownBefore: null};
+            var namaBulan = [
+                'Januari', 'Februari', 'Maret', 'April', 'Mei', 'Juni',
+                'Juli', 'Agustus', 'September', 'Oktober', 'November', 'Desember'
+            ];
+            function duaDigit(n) {
+                return (n < 10 ? '0' : '') + n;
+            }
+            function renderBulan(month, year) {
+                var offset = (new Date(year, month - 1, 1).getDay() + 6) % 7;
+                var days = new Date(year, month, 0).getDate();
+                var html = '<div class="calendar-month" id="month-' + month + '-' + year + '">' +
+                    '<div class="calendar-title">' + namaBulan[month - 1] + ' ' + year + '</div>' +
+                    '<div class="calendar-dates" id="dates-' + month + '-' + year + '">';
+                for (var i = 0; i < offset; i++) {
+                    html += '<div class="calendar-date" style="visibility: hidden;"></div>';
+                }
+                for (var day = 1; day <= days; day++) {
+                    var date = year + '-' + duaDigit(month) + '-' + duaDigit(day);
+                    var classes = 'calendar-date';
+                    if (date === kalender.selected) {
+                        classes += ' selected';
+                    }
+                    if (date === kalender.today) {
+                        classes += ' today';
+                    }
+                    // Hanya tanggal tanpa file sama sekali yang diblokir; tanggal yang baru punya
+                    // sebagian jenis file tetap bisa dipilih dan diberi keterangan
+                    var title = '';
+                    if (kalender.available && date < kalender.knownBefore) {
+                        var kinds = kalender.available[date];
+                        if (!kinds) {
+                            classes += ' unavailable';
+                        } else if (kinds.length < 2) {
+                            classes += ' partial';
+                            title = ' title="Hanya ' + kinds.join(', ') + ' tersedia"';
+                        }
+                    }
+                    html += '<div class="' + classes + '" data-date="' + date + '"' + title + '>' + day + '</div>';
+                }
+                return html + '</div></div>';
+            }
+            function renderKalender() {
+                var slider = document.getElementById('calendar-slider');
+                if (!slider || kalender.month === null) {
+                    return;
+                }
+                var month2 = kalender.month === 12 ? 1 : kalender.month + 1;
+                var year2 = kalender.month === 12 ? kalender.year + 1 : kalender.year;
+                slider.innerHTML = renderBulan(kalender.month, kalender.year) + renderBulan(month2, year2);
+            }
+            function geserBulan(step) {
+                if (kalender.month === null) {
+                    return;
+                }
+                var index = kalender.year * 12 + (kalender.month - 1) + step;
+                kalender.year = Math.floor(index / 12);
+                kalender.month = index % 12 + 1;
+                renderKalender();
+            }
             $(document).ready(function() {
                 console.log('Document ready');
                 $('#expand_peta').on('click', function() {
@@ -406,11 +3139,19 @@ app_ui = ui.page_fluid(
                 });
                 $(document).on('click', '#prev-month', function() {
                     console.log('Prev month clicked');
-                    Shiny.setInputValue('prev_month', Date.now(), {priority: 'event'});
+                    geserBulan(-1);
                 });
                 $(document).on('click', '#next-month', function() {
                     console.log('Next month clicked');
-                    Shiny.setInputValue('next_month', Date.now(), {priority: 'event'});
+                    geserBulan(1);
+                });
+                // Satu handler untuk semua tanggal (event delegation); klik hanya mengirim tanggal ke server
+                $(document).on('click', '#calendar-slider .calendar-date[data-date]:not(.unavailable)', function() {
+                    var date = this.getAttribute('data-date');
+                    $('#calendar-slider .calendar-date.selected').removeClass('selected');
+                    this.classList.add('selected');
+                    kalender.selected = date;
+                    Shiny.setInputValue('select_date', date, {priority: 'event'});
                 });
                 $(document).on('shown.bs.modal', function() {
                     setTimeout(function() {
@@ -435,17 +3176,34 @@ app_ui = ui.page_fluid(
                         }
                     }
                 });
-                Shiny.addCustomMessageHandler('update_calendar', function(message) {
-                    console.log('Update calendar:', message);
-                    document.querySelectorAll('.calendar-date.selected').forEach(function(el) {
-                        el.classList.remove('selected');
-                    });
-                    document.querySelectorAll('.calendar-date').forEach(function(el) {
-                        if (el.onclick && el.onclick.toString().includes(message.selected_date)) {
-                            el.classList.add('selected');
+                // Jumlah unduhan hanya dipasang bila key-nya (area_YYYYMMDD) masih yang sedang dilihat;
+                // pesan untuk pilihan sebelumnya bisa datang terlambat setelah pengguna pindah
+                Shiny.addCustomMessageHandler('update_download_count', function(message) {
+                    var area = $('#area').val();
+                    if (!kalender.selected || !area || message.key !== area + '_' + kalender.selected.replace(/-/g, '')) {
+                        return;
+                    }
+                    ['peta', 'tabel'].forEach(function(kind) {
+                        var element = document.getElementById(kind + '_download_count');
+                        if (element && message[kind] !== undefined) {
+                            element.textContent = 'Jumlah Unduhan: ' + message[kind];
                         }
                     });
                 });
+                Shiny.addCustomMessageHandler('calendar_availability', function(message) {
+                    console.log('Calendar availability:', message.area, Object.keys(message.dates).length);
+                    kalender.available = message.dates;
+                    kalender.knownBefore = message.known_before;
+                    renderKalender();
+                });
+                Shiny.addCustomMessageHandler('calendar_state', function(message) {
+                    console.log('Calendar state:', message);
+                    kalender.month = message.month;
+                    kalender.year = message.year;
+                    kalender.selected = message.selected_date;
+                    kalender.today = message.today;
+                    renderKalender();
+                });
             });
         """)
     ),
@@ -465,7 +3223,7 @@ app_ui = ui.page_fluid(
                     ui.input_select(
                         "area",
                         None,
-                        choices=["571", "572", "573", "711", "712", "713", "714", "715", "716", "717", "718"],
+                        choices=AREAS,
                         selected="712",
                         width="100%"
                     )
@@ -478,7 +3236,20 @@ app_ui = ui.page_fluid(
                     ui.tags.label("Pilih Tanggal", class_="input-label"),
                     ui.div(
                         {"class": "date-picker"},
-                        ui.output_ui("date_slider")
+                        ui.div(
+                            {"id": "date_slider", "class": "calendar-container"},
+                            ui.tags.button(
+                                ui.tags.i({"class": "fa fa-chevron-left"}),
+                                id="prev-month",
+                                class_="calendar-btn"
+                            ),
+                            ui.div({"id": "calendar-slider", "class": "calendar-slider"}),
+                            ui.tags.button(
+                                ui.tags.i({"class": "fa fa-chevron-right"}),
+                                id="next-month",
+                                class_="calendar-btn"
+                            )
+                        )
                     )
                 )
             )
@@ -510,6 +3281,21 @@ app_ui = ui.page_fluid(
             ui.div({"id": "tabel_output"}, ui.output_ui("tabel_content"))
         )
     ),
+    ui.div(
+        {"class": "content-box"},
+        ui.h3("Unduh Massal", class_="content-title"),
+        ui.row(
+            ui.column(
+                8,
+                ui.input_checkbox_group("ekspor_area", "Area WPP NRI", choices=AREAS, selected=["712"], inline=True),
+            ),
+            ui.column(
+                4,
+                ui.input_date_range("ekspor_tanggal", "Rentang Tanggal", start=datetime.now().date() - timedelta(days=6), end=datetime.now().date()),
+            ),
+        ),
+        ui.download_button("unduh_massal", "Unduh ZIP", class_="unduh-btn"),
+    ),
     ui.div(
         {"class": "footer"},
         ui.row(
@@ -567,15 +3353,76 @@ app_ui = ui.page_fluid(
 
 # Server logic
 def server(input, output, session):
+    ACTIVE_SESSIONS.inc()
+    active_sessions.add(session)
     selected_date = reactive.Value(datetime.now().date())
-    current_month = reactive.Value(5)
-    current_year = reactive.Value(2025)
-    images = reactive.Value(None)
-    download_counts = reactive.Value({"peta": {}, "tabel": {}})
-    peta_loading = reactive.Value(True)
-    tabel_loading = reactive.Value(True)
-    peta_visible = reactive.Value(False)
-    tabel_visible = reactive.Value(False)
+
+    # Area dan tanggal yang sedang dilihat sebagai field log; hanya dibaca bila record benar-benar ditulis
+    def konteks_log():
+        with reactive.isolate():
+            return {"area": input.area(), "date": selected_date.get().strftime("%Y%m%d")}
+
+    log = SessionLogger(logger, session.id, konteks_log)
+    # Hasil unduhan per jenis file ({"path", "error"}); panel peta dan tabel diperbarui sendiri-sendiri.
+    # Dict hasil adalah objek yang sama dengan hasil single-flight (dipakai bersama antar sesi);
+    # isi gambarnya ada di cache memori proses, bukan di sesi.
+    images = {kind: reactive.Value(None) for kind in KINDS}
+    
+    # Unduhan berjalan di luar siklus reaktif; sesi tetap responsif selama menunggu FTP.
+    # Satu task per jenis file sehingga peta dan tabel diunduh bersamaan.
+    def buat_tugas_unduh(kind):
+        @reactive.extended_task
+        async def ambil_gambar(area, date):
+            result = await download_file_async(kind, area, date)
+            # Muat isi gambar ke cache memori agar render dan modal tidak membaca disk
+            await asyncio.to_thread(preload_payload, result["path"])
+            return result
+        return ambil_gambar
+    
+    tugas_unduh = {kind: buat_tugas_unduh(kind) for kind in KINDS}
+
+    # Prefetch tanggal di sekitar tanggal yang dipilih; dibatalkan saat pengguna pindah area/tanggal.
+    # Hasilnya tidak ditampilkan, jadi cukup task asyncio biasa (tanpa state reaktif)
+    prefetch_sekitar = [None]
+
+    def batalkan_prefetch():
+        if prefetch_sekitar[0] is not None:
+            prefetch_sekitar[0].cancel()
+            prefetch_sekitar[0] = None
+
+    def mulai_prefetch(area, date):
+        batalkan_prefetch()
+        task = asyncio.get_running_loop().create_task(prefetch_adjacent(area, date))
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        prefetch_sekitar[0] = task
+
+    # Hentikan unduhan milik sesi ini saat browser ditutup
+    @session.on_ended
+    def batalkan_unduhan():
+        ACTIVE_SESSIONS.dec()
+        active_sessions.discard(session)
+        batalkan_prefetch()
+        for tugas in tugas_unduh.values():
+            tugas.cancel()
+        count_hub.unsubscribe(session)
+
+    # Sesi berlangganan jumlah unduhan untuk area/tanggal yang sedang dilihat;
+    # perubahan dari sesi lain dikirim lewat pesan "update_download_count"
+    @reactive.Effect
+    def langganan_jumlah_unduhan():
+        count_hub.subscribe(session, f"{input.area()}_{selected_date.get().strftime('%Y%m%d')}")
+
+    # Tampilkan loading spinner panel, sembunyikan outputnya
+    async def tampilkan_loading(kind):
+        await session.send_custom_message("update_visibility", {"element_id": f"{kind}_loading", "show": True})
+        await session.send_custom_message("update_visibility", {"element_id": f"{kind}_output", "show": False})
+
+    # Sembunyikan loading spinner panel, tampilkan output, lalu pasang hasil unduhannya
+    async def tampilkan_hasil(kind, result):
+        await session.send_custom_message("update_visibility", {"element_id": f"{kind}_loading", "show": False})
+        await session.send_custom_message("update_visibility", {"element_id": f"{kind}_output", "show": True})
+        
+        images[kind].set(result)
     
     # Bagian fetch_images()
     @reactive.Effect
@@ -584,189 +3431,119 @@ def server(input, output, session):
         area = input.area()
         date = selected_date.get()
         if not area or not date:
-            logger.debug("Area atau tanggal tidak valid")
+            log.debug("Area atau tanggal tidak valid")
             return
-        logger.debug(f"Fetching images for area: {area}, date: {date}")
-        # Tampilkan loading spinner, sembunyikan output
-        peta_loading.set(True)
-        tabel_loading.set(True)
-        peta_visible.set(False)
-        tabel_visible.set(False)
-        await session.send_custom_message("update_visibility", {"element_id": "peta_loading", "show": True})
-        await session.send_custom_message("update_visibility", {"element_id": "tabel_loading", "show": True})
-        await session.send_custom_message("update_visibility", {"element_id": "peta_output", "show": False})
-        await session.send_custom_message("update_visibility", {"element_id": "tabel_output", "show": False})
-        
-        result = download_from_ftp(area, date)
-        
-        # Sembunyikan loading spinner, tampilkan output
-        peta_loading.set(False)
-        tabel_loading.set(False)
-        peta_visible.set(True)
-        tabel_visible.set(True)
-        await session.send_custom_message("update_visibility", {"element_id": "peta_loading", "show": False})
-        await session.send_custom_message("update_visibility", {"element_id": "tabel_loading", "show": False})
-        await session.send_custom_message("update_visibility", {"element_id": "peta_output", "show": True})
-        await session.send_custom_message("update_visibility", {"element_id": "tabel_output", "show": True})
-        
-        images.set(result)
-        #logger.debug(f"Images updated: {result}")
+        log.debug("Fetching images for area: %s, date: %s", area, date)
+        # Batalkan unduhan sebelumnya milik sesi ini, lalu mulai unduhan baru per jenis file
+        batalkan_prefetch()
+        for kind, tugas in tugas_unduh.items():
+            tugas.cancel()
+            # File yang menurut indeks tidak ada di FTP tidak perlu menunggu unduhan gagal
+            if availability_index.known_missing(area, date, [kind]):
+                log.debug("File %s tidak tersedia menurut indeks untuk area: %s, tanggal: %s", kind, area, date)
+                await tampilkan_hasil(kind, UNAVAILABLE_RESULT)
+                continue
+            await tampilkan_loading(kind)
+            tugas.invoke(area, date)
     
-    @output
-    @render.ui
-    @reactive.event(current_month, current_year, selected_date)
-    def date_slider():
-        month1 = current_month.get()
-        year1 = current_year.get()
-        month2 = 1 if month1 == 12 else month1 + 1
-        year2 = year1 + 1 if month1 == 12 else year1
-        month_names = [
-            "Januari", "Februari", "Maret", "April", "Mei", "Juni",
-            "Juli", "Agustus", "September", "Oktober", "November", "Desember"
-        ]
-        logger.debug(f"Rendering date slider for month1: {month1}, year1: {year1}, month2: {month2}, year2: {year2}")
-        
-        # Bulan pertama
-        first_day_month1 = datetime(year1, month1, 1)
-        last_day_month1 = (first_day_month1 + relativedelta(months=1) - timedelta(days=1))
-        weekday_start_month1 = first_day_month1.weekday() + 1
-        days_in_month1 = last_day_month1.day
-        
-        # Bulan kedua
-        first_day_month2 = datetime(year2, month2, 1)
-        last_day_month2 = (first_day_month2 + relativedelta(months=1) - timedelta(days=1))
-        weekday_start_month2 = first_day_month2.weekday() + 1
-        days_in_month2 = last_day_month2.day
-        
-        # Tanggal bulan pertama
-        month1_dates = []
-        for day in range(1, days_in_month1 + 1):
-            date = datetime(year1, month1, day).date()
-            is_today = date == datetime.now().date()
-            is_selected = date == selected_date.get()
-            classes = "calendar-date"
-            if is_selected:
-                classes += " selected"
-            if is_today:
-                classes += " today"
-            month1_dates.append(
-                ui.tags.div(
-                    {"class": classes, "onclick": f"Shiny.setInputValue('select_date', '{date.strftime('%Y-%m-%d')}', {{priority: 'event'}});"},
-                    str(day)
-                )
-            )
-        month1_dates = [ui.tags.div({"class": "calendar-date", "style": "visibility: hidden;"}) for _ in range(weekday_start_month1 - 1)] + month1_dates
-        
-        # Tanggal bulan kedua
-        month2_dates = []
-        for day in range(1, days_in_month2 + 1):
-            date = datetime(year2, month2, day).date()
-            is_today = date == datetime.now().date()
-            is_selected = date == selected_date.get()
-            classes = "calendar-date"
-            if is_selected:
-                classes += " selected"
-            if is_today:
-                classes += " today"
-            month2_dates.append(
-                ui.tags.div(
-                    {"class": classes, "onclick": f"Shiny.setInputValue('select_date', '{date.strftime('%Y-%m-%d')}', {{priority: 'event'}});"},
-                    str(day)
-                )
-            )
-        month2_dates = [ui.tags.div({"class": "calendar-date", "style": "visibility: hidden;"}) for _ in range(weekday_start_month2 - 1)] + month2_dates
-        
-        return ui.div(
-            {"class": "calendar-container"},
-            ui.tags.button(
-                ui.tags.i({"class": "fa fa-chevron-left"}),
-                id="prev-month",
-                class_="calendar-btn"
-            ),
-            ui.div(
-                {"id": "calendar-slider", "class": "calendar-slider"},
-                ui.div(
-                    {"class": "calendar-month", "id": f"month-{month1}-{year1}"},
-                    ui.tags.div({"class": "calendar-title"}, f"{month_names[month1-1]} {year1}"),
-                    ui.tags.div({"class": "calendar-dates", "id": f"dates-{month1}-{year1}"}, month1_dates)
-                ),
-                ui.div(
-                    {"class": "calendar-month", "id": f"month-{month2}-{year2}"},
-                    ui.tags.div({"class": "calendar-title"}, f"{month_names[month2-1]} {year2}"),
-                    ui.tags.div({"class": "calendar-dates", "id": f"dates-{month2}-{year2}"}, month2_dates)
-                )
-            ),
-            ui.tags.button(
-                ui.tags.i({"class": "fa fa-chevron-right"}),
-                id="next-month",
-                class_="calendar-btn"
-            )
-        )
+    # Bagian apply_images(): dijalankan setiap kali unduhan satu jenis file selesai
+    def buat_pemasang_hasil(kind):
+        tugas = tugas_unduh[kind]
+
+        @reactive.Effect
+        async def apply_images():
+            status = tugas.status()
+            if status not in ("success", "error"):
+                return
+            with reactive.isolate():
+                if status == "success":
+                    result = tugas.result()
+                else:
+                    error = tugas.error.get()
+                    log.error("Unduhan %s gagal: %s", kind, error, extra={"kind": kind})
+                    result = {"path": None, "error": FETCH_FAILED}
+                # Semua unduhan utama selesai; mulai prefetch tanggal di sekitarnya
+                selesai = not any(t.status() == "running" for t in tugas_unduh.values())
+                if selesai and ADJACENT_PREFETCH_DAYS > 0:
+                    mulai_prefetch(input.area(), selected_date.get())
+            
+            await tampilkan_hasil(kind, result)
+        return apply_images
     
-    # Bagian tombol prev - next month
+    for kind in KINDS:
+        buat_pemasang_hasil(kind)
+    
+    # Bagian kirim_kalender(): kalender dirender di browser dari state ini
     @reactive.Effect
-    @reactive.event(input.prev_month)
-    async def prev_month():
-        logger.debug(f"Tombol prev_month diklik, input.prev_month: {input.prev_month()}")
-        month = current_month.get()
-        year = current_year.get()
-        if month is None or year is None:
-            logger.error("Nilai month atau year tidak valid")
-            return
-        if month == 1:
-            current_month.set(12)
-            current_year.set(year - 1)
-        else:
-            current_month.set(month - 1)
-        logger.debug(f"Updated to month: {current_month.get()}, year: {current_year.get()}")
-        await session.send_custom_message("update_calendar", {
-            "selected_date": selected_date.get().strftime("%Y-%m-%d"),
-            "month": current_month.get(),
-            "year": current_year.get()
+    async def kirim_kalender():
+        with reactive.isolate():
+            date = selected_date.get()
+        await session.send_custom_message("calendar_state", {
+            "selected_date": date.strftime("%Y-%m-%d"),
+            "today": datetime.now().date().strftime("%Y-%m-%d"),
+            "month": date.month,
+            "year": date.year
         })
-
+    
+    # Versi indeks ketersediaan dicek berkala; kalender diperbarui hanya bila indeks berubah
+    @reactive.poll(lambda: availability_index.version, AVAILABILITY_POLL_INTERVAL)
+    def versi_ketersediaan():
+        return availability_index.version
+    
+    # Bagian kirim_ketersediaan(): jenis file yang ada per tanggal; tanggal tanpa file digelapkan di kalender
     @reactive.Effect
-    @reactive.event(input.next_month)
-    async def next_month():
-        logger.debug(f"Tombol next_month diklik, input.next_month: {input.next_month()}")
-        month = current_month.get()
-        year = current_year.get()
-        if month is None or year is None:
-            logger.error("Nilai month atau year tidak valid")
+    async def kirim_ketersediaan():
+        area = input.area()
+        versi_ketersediaan()
+        known_before = availability_index.known_before()
+        if not area or known_before is None:
             return
-        if month == 12:
-            current_month.set(1)
-            current_year.set(year + 1)
-        else:
-            current_month.set(month + 1)
-        logger.debug(f"Updated to month: {current_month.get()}, year: {current_year.get()}")
-        await session.send_custom_message("update_calendar", {
-            "selected_date": selected_date.get().strftime("%Y-%m-%d"),
-            "month": current_month.get(),
-            "year": current_year.get()
+        await session.send_custom_message("calendar_availability", {
+            "area": area,
+            "dates": {f"{d[:4]}-{d[4:6]}-{d[6:]}": kinds for d, kinds in availability_index.available_dates(area).items()},
+            "known_before": known_before.strftime("%Y-%m-%d")
         })
     
+    # Versi revalidator dicek berkala; gambar yang diunduh ulang karena berubah di server
+    # dipasang kembali di sesi yang sedang melihatnya sehingga URL (?v=) ikut berganti
+    @reactive.poll(lambda: revalidator.version, REVALIDATE_POLL_INTERVAL)
+    def versi_revalidasi():
+        return revalidator.version
+
+    versi_terlihat = [revalidator.version]
+
+    # Bagian muat_ulang_gambar_berubah()
+    @reactive.Effect
+    def muat_ulang_gambar_berubah():
+        versi = versi_revalidasi()
+        berubah = revalidator.refreshed_since(versi_terlihat[0])
+        versi_terlihat[0] = versi
+        if not berubah:
+            return
+        with reactive.isolate():
+            date_str = selected_date.get().strftime("%Y%m%d")
+            for kind in KINDS:
+                current = images[kind].get()
+                if (kind, input.area(), date_str) in berubah and current and current["path"]:
+                    log.info("Gambar %s diperbarui dari server, dirender ulang", kind)
+                    images[kind].set({"path": current["path"], "error": None})
+
     # Bagian update_selected_date()
     @reactive.Effect
     @reactive.event(input.select_date)
-    async def update_selected_date():
-        logger.debug(f"Tanggal dipilih: {input.select_date()}")
+    def update_selected_date():
+        log.debug("Tanggal dipilih: %s", input.select_date())
         selected_date.set(datetime.strptime(input.select_date(), "%Y-%m-%d").date())
-        await session.send_custom_message("update_calendar", {
-            "selected_date": input.select_date()
-        })
     
     @output
     @render.ui
+    @timed_render("peta_content")
     def peta_content():
-        img_data = images.get()
-        logger.debug(f"Rendering peta_content, img_data['peta']: {img_data['peta'] if img_data else None}")
-        if img_data and img_data["peta"] and os.path.exists(img_data["peta"]):
-            with open(img_data["peta"], "rb") as f:
-                img_base64 = base64.b64encode(f.read()).decode()
-            return ui.tags.img(
-                {"src": f"data:image/png;base64,{img_base64}", "style": "max-width:100%; max-height:600px; display: block; margin: 0 auto;"}
-            )
+        img_data = images["peta"].get()
+        log.debug("Rendering peta_content: %s", img_data and img_data["path"])
+        img = dpi_image_tag(img_data["path"], INLINE_IMAGE_STYLE, INLINE_IMAGE_SIZES) if img_data and img_data["path"] else None
+        if img:
+            return img
         else:
             error_message = img_data["error"] if img_data and img_data["error"] else None
             return ui.div(
@@ -778,15 +3555,13 @@ def server(input, output, session):
     
     @output
     @render.ui
+    @timed_render("tabel_content")
     def tabel_content():
-        img_data = images.get()
-        logger.debug(f"Rendering tabel_content, img_data['tabel']: {img_data['tabel'] if img_data else None}")
-        if img_data and img_data["tabel"] and os.path.exists(img_data["tabel"]):
-            with open(img_data["tabel"], "rb") as f:
-                img_base64 = base64.b64encode(f.read()).decode()
-            return ui.tags.img(
-                {"src": f"data:image/png;base64,{img_base64}", "style": "max-width:100%; max-height:600px; display: block; margin: 0 auto;"}
-            )
+        img_data = images["tabel"].get()
+        log.debug("Rendering tabel_content: %s", img_data and img_data["path"])
+        img = dpi_image_tag(img_data["path"], INLINE_IMAGE_STYLE, INLINE_IMAGE_SIZES) if img_data and img_data["path"] else None
+        if img:
+            return img
         else:
             error_message = img_data["error"] if img_data and img_data["error"] else None
             return ui.div(
@@ -796,90 +3571,104 @@ def server(input, output, session):
                 ui.p(error_message) if error_message else None
             )
     
+    def hitung_unduhan(kind, key):
+        counter_store.increment(kind, key)
+        count_hub.publish(key)
+        log.debug("Unduhan %s untuk %s dicatat", kind, key)
+    
+    # File yang sudah ada di cache dikirim sebagai path (FileResponse: Content-Length di depan,
+    # dibaca per potongan). Jika belum ada, file diambil lewat jalur unduhan biasa lalu di-stream.
+    def siapkan_unduhan(kind):
+        area = input.area()
+        date = selected_date.get()
+        date_str = date.strftime("%Y%m%d")
+        key = f"{area}_{date_str}"
+        path = dpi_cache.get(kind, area, date_str)
+        if path is not None:
+            hitung_unduhan(kind, key)
+            return path
+        
+        async def stream():
+            found = False
+            async for chunk in stream_dpi_file(kind, area, date):
+                if not found:
+                    found = True
+                    hitung_unduhan(kind, key)
+                yield chunk
+            if not found:
+                ui.notification_show(f"File {kind} tidak ditemukan untuk diunduh", type="error")
+                log.error("Gagal mengunduh %s: File tidak ditemukan", kind, extra={"kind": kind})
+        
+        return stream()
+    
     @output
-    @render.download(filename=lambda: f"peta_dpi_{input.area()}_{selected_date.get().strftime('%Y%m%d')}.png")
+    @render.download(filename=lambda: f"peta_dpi_{input.area()}_{selected_date.get().strftime('%Y%m%d')}.png", media_type="image/png")
     def unduh_peta():
-        img_data = images.get()
-        logger.debug(f"Tombol unduh_peta diklik, img_data['peta']: {img_data['peta'] if img_data else None}")
-        if img_data and img_data["peta"] and os.path.exists(img_data["peta"]):
-            key = f"{input.area()}_{selected_date.get().strftime('%Y%m%d')}"
-            counts = download_counts.get()
-            counts["peta"][key] = counts["peta"].get(key, 0) + 1
-            download_counts.set(counts)
-            logger.debug(f"Jumlah unduhan peta untuk {key}: {counts['peta'][key]}")
-            with open(img_data["peta"], "rb") as f:
-                yield f.read()
-        else:
-            ui.notification_show("File peta tidak ditemukan untuk diunduh", type="error")
-            logger.error("Gagal mengunduh peta: File tidak ditemukan")
+        log.debug("Tombol unduh_peta diklik untuk area: %s, tanggal: %s", input.area(), selected_date.get())
+        return siapkan_unduhan("peta")
     
     @output
-    @render.download(filename=lambda: f"tabel_dpi_{input.area()}_{selected_date.get().strftime('%Y%m%d')}.png")
+    @render.download(filename=lambda: f"tabel_dpi_{input.area()}_{selected_date.get().strftime('%Y%m%d')}.png", media_type="image/png")
     def unduh_tabel():
-        img_data = images.get()
-        logger.debug(f"Tombol unduh_tabel diklik, img_data['tabel']: {img_data['tabel'] if img_data else None}")
-        if img_data and img_data["tabel"] and os.path.exists(img_data["tabel"]):
-            key = f"{input.area()}_{selected_date.get().strftime('%Y%m%d')}"
-            counts = download_counts.get()
-            counts["tabel"][key] = counts["tabel"].get(key, 0) + 1
-            download_counts.set(counts)
-            logger.debug(f"Jumlah unduhan tabel untuk {key}: {counts['tabel'][key]}")
-            with open(img_data["tabel"], "rb") as f:
-                yield f.read()
-        else:
-            ui.notification_show("File tabel tidak ditemukan untuk diunduh", type="error")
-            logger.error("Gagal mengunduh tabel: File tidak ditemukan")
+        log.debug("Tombol unduh_tabel diklik untuk area: %s, tanggal: %s", input.area(), selected_date.get())
+        return siapkan_unduhan("tabel")
+    
+    def ekspor_terpilih():
+        start, end = input.ekspor_tanggal()
+        return parse_export_request(input.ekspor_area(), start, end)
+
+    def nama_ekspor():
+        try:
+            return export_filename(ekspor_terpilih()[1])
+        except (TypeError, ValueError):
+            return "dpi_ekspor.zip"
+
+    @output
+    @render.download(filename=nama_ekspor, media_type="application/zip")
+    def unduh_massal():
+        try:
+            areas, dates, kinds = ekspor_terpilih()
+        except (TypeError, ValueError) as e:
+            # Gagalkan permintaan unduhan agar browser tidak menyimpan ZIP kosong
+            ui.notification_show(f"Ekspor gagal: {e}", type="error")
+            raise
+        log.info("Ekspor massal %d area, %s s.d. %s", len(areas), dates[0], dates[-1])
+        return stream_export_zip(areas, dates, kinds)
     
     @output
     @render.text
-    def peta_download_count():
+    async def peta_download_count():
         key = f"{input.area()}_{selected_date.get().strftime('%Y%m%d')}"
-        count = download_counts.get()["peta"].get(key, 0)
-        logger.debug(f"Menampilkan jumlah unduhan peta untuk {key}: {count}")
+        count = await asyncio.to_thread(counter_store.get, "peta", key)
+        log.debug("Menampilkan jumlah unduhan peta untuk %s: %s", key, count)
         return f"Jumlah Unduhan: {count}"
     
     @output
     @render.text
-    def tabel_download_count():
+    async def tabel_download_count():
         key = f"{input.area()}_{selected_date.get().strftime('%Y%m%d')}"
-        count = download_counts.get()["tabel"].get(key, 0)
-        logger.debug(f"Menampilkan jumlah unduhan tabel untuk {key}: {count}")
+        count = await asyncio.to_thread(counter_store.get, "tabel", key)
+        log.debug("Menampilkan jumlah unduhan tabel untuk %s: %s", key, count)
         return f"Jumlah Unduhan: {count}"
     
     
     @reactive.Effect
     @reactive.event(input.expand_peta)
     def expand_peta():
-        img_data = images.get()
+        img_data = images["peta"].get()
         
-        logger.debug(f"Tombol expand peta diklik, img_data: {img_data}")
+        log.debug("Tombol expand peta diklik: %s", img_data and img_data["path"])
         
         # Perbaikan
-        has_valid_image = (img_data is not None and 
-                        img_data.get("peta") is not None and 
-                        os.path.exists(img_data.get("peta", "")))
+        img = dpi_image_tag(img_data["path"], MODAL_IMAGE_STYLE, MODAL_IMAGE_SIZES) if img_data and img_data.get("path") else None
         
-        logger.debug(f"File peta valid: {has_valid_image}")
+        log.debug("File peta valid: %s", img is not None)
         
-        if has_valid_image:
-            try:
-                with open(img_data["peta"], 'rb') as f:
-                    img_base64 = base64.b64encode(f.read()).decode()
-                
-                content = ui.div(
-                    {"style": "width:100%; text-align:center;"},
-                    ui.tags.img(
-                        {"src": f"data:image/png;base64,{img_base64}", 
-                        "style": "max-width:100%; max-height:700px;"}
-                    )
-                )
-            except Exception as e:
-                logger.error(f"Error saat membuka file peta: {str(e)}")
-                content = ui.div(
-                    {"class": "placeholder-text"},
-                    ui.p(f"Terjadi kesalahan saat membuka file peta: {str(e)}"),
-                    ui.p("Silakan coba lagi dalam beberapa saat.")
-                )
+        if img:
+            content = ui.div(
+                {"style": "width:100%; text-align:center;"},
+                img
+            )
         else:
             content = ui.div(
                 {"class": "placeholder-text"},
@@ -900,36 +3689,20 @@ def server(input, output, session):
     @reactive.Effect
     @reactive.event(input.expand_tabel)
     def expand_tabel():
-        img_data = images.get()
+        img_data = images["tabel"].get()
         
-        logger.debug(f"Tombol expand tabel diklik, img_data: {img_data}")
+        log.debug("Tombol expand tabel diklik: %s", img_data and img_data["path"])
         
         # Perbaikan
-        has_valid_image = (img_data is not None and 
-                        img_data.get("tabel") is not None and 
-                        os.path.exists(img_data.get("tabel", "")))
+        img = dpi_image_tag(img_data["path"], MODAL_IMAGE_STYLE, MODAL_IMAGE_SIZES) if img_data and img_data.get("path") else None
         
-        logger.debug(f"File tabel valid: {has_valid_image}")
+        log.debug("File tabel valid: %s", img is not None)
         
-        if has_valid_image:
-            try:
-                with open(img_data["tabel"], 'rb') as f:
-                    img_base64 = base64.b64encode(f.read()).decode()
-                
-                content = ui.div(
-                    {"style": "width:100%; text-align:center;"},
-                    ui.tags.img(
-                        {"src": f"data:image/png;base64,{img_base64}", 
-                        "style": "max-width:100%; max-height:700px;"}
-                    )
-                )
-            except Exception as e:
-                logger.error(f"Error saat membuka file tabel: {str(e)}")
-                content = ui.div(
-                    {"class": "placeholder-text"},
-                    ui.p(f"Terjadi kesalahan saat membuka file tabel: {str(e)}"),
-                    ui.p("Silakan coba lagi dalam beberapa saat.")
-                )
+        if img:
+            content = ui.div(
+                {"style": "width:100%; text-align:center;"},
+                img
+            )
         else:
             content = ui.div(
                 {"class": "placeholder-text"},
@@ -949,19 +3722,229 @@ def server(input, output, session):
     # Bagian initialize_visibility()
     @reactive.Effect
     async def initialize_visibility():
-        logger.debug("Initializing visibility")
-        peta_loading.set(True)
-        tabel_loading.set(True)
-        peta_visible.set(False)
-        tabel_visible.set(False)
-        await session.send_custom_message("update_visibility", {"element_id": "peta_loading", "show": True})
-        await session.send_custom_message("update_visibility", {"element_id": "tabel_loading", "show": True})
-        await session.send_custom_message("update_visibility", {"element_id": "peta_output", "show": False})
-        await session.send_custom_message("update_visibility", {"element_id": "tabel_output", "show": False})
+        log.debug("Initializing visibility")
+        for kind in KINDS:
+            await tampilkan_loading(kind)
+
+    # Objek milik sesi ini sebagai titik awal laporan memori /sessions
+    session_roots[session] = [value for name, value in locals().items() if name != "session"]
+
+@asynccontextmanager
+async def lifespan(starlette_app):
+    baseline_rss[0] = process_rss()
+    await asyncio.to_thread(counter_store.open)
+    if CACHE_WARM_ON_START:
+        warm_cache()
+    if PREFETCH_ENABLED:
+        prefetcher.start()
+    if AVAILABILITY_ENABLED:
+        availability_index.start()
+    try:
+        async with shiny_app.starlette_app.router.lifespan_context(starlette_app):
+            yield
+    finally:
+        prefetcher.stop()
+        availability_index.stop()
+        counter_store.close()
+
+
+def counted(handler):
+    @functools.wraps(handler)
+    async def wrapper(request):
+        response = await handler(request)
+        HTTP_REQUESTS.inc(status=response.status_code)
+        return response
+    return wrapper
+
+
+# Route HTTP untuk gambar DPI. Gambar dikirim sebagai file biasa (bukan base64 lewat websocket)
+# sehingga bisa di-cache browser dan mendukung ETag, Last-Modified, dan Range. Hanya file yang
+# memang tidak ada yang dijawab 404; gangguan sumber gambar dijawab 503 dengan Retry-After
+# agar browser dan proxy tidak menganggapnya permanen.
+async def dpi_image(request):
+    match = DPI_FILENAME_RE.match(request.path_params["filename"])
+    if not match or match.group("area") not in AREAS:
+        return PlainTextResponse("Not Found", status_code=404)
+    kind, area, date_str = match.group("kind"), match.group("area"), match.group("date")
+    path = await asyncio.to_thread(dpi_cache.get, kind, area, date_str)
+    if path is None:
+        # Belum ada di cache: unduh lewat jalur yang sama dengan sesi (single-flight)
+        try:
+            selected_date = datetime.strptime(date_str, "%Y%m%d").date()
+        except ValueError:
+            return PlainTextResponse("Not Found", status_code=404)
+        result = await download_file_async(kind, area, selected_date)
+        path = result["path"]
+        if path is None and is_missing_result(result):
+            return PlainTextResponse("Not Found", status_code=404)
+        if path is None:
+            return PlainTextResponse(
+                "Service Unavailable", status_code=503,
+                headers={"retry-after": str(max(1, math.ceil(FTP_TRANSIENT_TTL))), "cache-control": "no-store"},
+            )
+    else:
+        revalidate(kind, area, date_str)
+    entry = payload_cache.lookup((kind, area, date_str))
+    if entry is None:
+        entry = await asyncio.to_thread(payload_cache.load, (kind, area, date_str), path)
+    if entry is None:
+        # Terlalu besar untuk cache memori: kirim langsung dari disk
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return PlainTextResponse("Not Found", status_code=404)
+        response = FileResponse(path, media_type="image/png", stat_result=stat)
+        response.headers["Cache-Control"] = f"public, max-age={DPI_IMAGE_MAX_AGE}"
+        if not_modified(request, response.headers):
+            return Response(status_code=304, headers={
+                key: response.headers[key] for key in ("etag", "last-modified", "cache-control")
+            })
+        return response
+    headers = {
+        "etag": entry.etag,
+        "last-modified": entry.last_modified,
+        "cache-control": f"public, max-age={DPI_IMAGE_MAX_AGE}",
+        "accept-ranges": "bytes",
+    }
+    body = entry.data
+    media_type = "image/png"
+    size = request.query_params.get("size", "full")
+    fmt = request.query_params.get("format", "png")
+    if (size == "full" or size in VARIANT_WIDTHS) and (fmt == "png" or fmt in VARIANT_FORMATS):
+        variant = await asyncio.to_thread(get_variant, entry, size, fmt)
+        if variant is not None:
+            body, media_type, headers["etag"] = variant
+    if not_modified(request, headers):
+        return Response(status_code=304, headers={key: headers[key] for key in ("etag", "last-modified", "cache-control")})
+    status_code = 200
+    total = len(body)
+    byte_range = parse_range(request, headers, total)
+    if byte_range == "unsatisfiable":
+        return Response(status_code=416, headers={"content-range": f"bytes */{total}"})
+    if byte_range is not None:
+        start, end = byte_range
+        body = body[start:end + 1]
+        status_code = 206
+        headers["content-range"] = f"bytes {start}-{end}/{total}"
+    if request.method == "HEAD":
+        headers["content-length"] = str(len(body))
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
+    return Response(body, status_code=status_code, headers=headers, media_type=media_type)
+
+
+# Hanya satu rentang byte yang didukung; permintaan multi-rentang dijawab dengan file utuh
+def parse_range(request, headers, size):
+    http_range = request.headers.get("range")
+    if not http_range or not http_range.startswith("bytes=") or "," in http_range:
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range and if_range not in (headers["etag"], headers["last-modified"]):
+        return None
+    start, _, end = http_range[len("bytes="):].strip().partition("-")
+    try:
+        if start:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+        else:
+            # Rentang sufiks: N byte terakhir
+            start = max(size - int(end), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return "unsatisfiable"
+    return start, end
+
+
+async def prefetch_status(request):
+    return JSONResponse(prefetcher.status())
+
+
+async def metrics_endpoint(request):
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+async def availability_status(request):
+    return JSONResponse(availability_index.status())
+
+
+# /export?areas=711,712&start=2025-01-01&end=2025-01-07[&kinds=peta,tabel]
+async def export_zip(request):
+    params = request.query_params
+    try:
+        areas, dates, kinds = parse_export_request(
+            params.get("areas", "").split(","),
+            params.get("start", ""),
+            params.get("end", ""),
+            params["kinds"].split(",") if "kinds" in params else None,
+        )
+    except ValueError as e:
+        return PlainTextResponse(str(e), status_code=400)
+    return StreamingResponse(
+        stream_export_zip(areas, dates, kinds),
+        media_type="application/zip",
+        headers={
+            "content-disposition": f'attachment; filename="{export_filename(dates)}"',
+            "cache-control": "no-store",
+        },
+    )
+
+
+async def sessions_status(request):
+    supplied = request.headers.get("authorization", "").removeprefix("Bearer ")
+    if not SESSION_REPORT_TOKEN:
+        return PlainTextResponse("Not Found", status_code=404)
+    if not hmac.compare_digest(supplied.encode(), SESSION_REPORT_TOKEN.encode()):
+        return PlainTextResponse("Unauthorized", status_code=401, headers={"www-authenticate": "Bearer"})
+    if session_report_lock.locked():
+        return PlainTextResponse("Laporan sedang dibuat", status_code=429, headers={"retry-after": "5"})
+    async with session_report_lock:
+        sessions = list(active_sessions)
+        roots = [session_roots.get(session, ()) for session in sessions[:SESSION_REPORT_SAMPLE]]
+        report = await asyncio.to_thread(session_report, sessions, roots, asyncio.get_running_loop())
+    return JSONResponse(report)
+
+
+async def cache_status(request):
+    return JSONResponse({
+        "memory": payload_cache.stats(),
+        "revalidation": revalidator.stats(),
+        "worker": {"id": WORKER_ID, "pid": os.getpid(), "background": background_leader.held()},
+    })
+
+
+def not_modified(request, headers):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        etags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in etags or headers["etag"] in etags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(headers["last-modified"])
+        except (TypeError, ValueError):
+            return False
+    return False
+
 
 # Run the application
-app = App(app_ui, server, static_assets=os.path.join(os.path.dirname(__file__), "www"))
+shiny_app = App(app_ui, server, static_assets=os.path.join(os.path.dirname(__file__), "www"))
+app = Starlette(
+    routes=[
+        Route("/dpi/{filename}", counted(dpi_image), methods=["GET", "HEAD"]),
+        Route("/prefetch", prefetch_status),
+        Route("/cache", cache_status),
+        Route("/availability", availability_status),
+        Route("/sessions", sessions_status),
+        Route("/metrics", metrics_endpoint),
+        Route("/export", export_zip),
+        Mount("/", app=shiny_app),
+    ],
+    lifespan=lifespan,
+)
 
+# Satu proses; untuk beberapa worker (mode multi-worker) jalankan serve.py
 if __name__ == "__main__":
     logger.debug("Starting application")
-    app.run()
+    # log_config=None: log uvicorn ikut lewat handler antrean dan format yang sama
+    uvicorn.run(app, host=os.getenv("HOST", "127.0.0.1"), port=int(os.getenv("PORT", "8000")), log_config=None)
@@ -0,0 +1,522 @@
+# Simulator FTP dengan injeksi gangguan dan runner skenario untuk final_app.py.
+#
+# Server FTP lokal (pyftpdlib) yang bisa dibuat lambat, macet saat RETR, memutus koneksi,
+# memotong transfer di tengah jalan, atau menolak login. Runner menjalankan aplikasi di bawah
+# uvicorn, menyalakan gangguan selama beberapa detik sementara sesi websocket simulasi terus
+# berpindah tampilan, lalu mematikannya dan mengukur:
+# - responsivitas sesi (spinner muncul, panel selesai, endpoint HTTP tetap menjawab),
+# - waktu pulih setelah gangguan hilang,
+# - kebocoran: file .part di cache, file rusak yang ikut tersimpan, fd/thread, koneksi FTP.
+#
+#   pip install pyftpdlib websockets
+#   python ftp_faults.py run                       # semua skenario
+#   python ftp_faults.py run lambat terpotong      # skenario tertentu
+#   python ftp_faults.py serve --root ./data --latency 0.5 --drop-rate 0.2
+import argparse
+import asyncio
+import errno
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import date, timedelta
+
+from benchmark import (
+    AREAS, FTP_PASSWORD, FTP_USER, CountingFtpHandler, SimulatedSession, Stats,
+    free_port, rss_bytes, scrape_metric, seed_files, start_app,
+)
+
+import websockets
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import DTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+# Perintah login tidak pernah diputus agar gangguan login bisa diuji terpisah
+LOGIN_COMMANDS = {"USER", "PASS", "QUIT"}
+
+
+# Gangguan yang sedang aktif; diubah saat server berjalan sehingga satu server dipakai
+# untuk fase normal, fase gangguan, dan fase pemulihan
+class FaultPlan:
+    FIELDS = {
+        "latency": 0.0,          # jeda (detik) sebelum setiap perintah dijawab
+        "stall": 0.0,            # RETR menahan jawaban selama sekian detik (meniru server macet)
+        "drop_rate": 0.0,        # peluang koneksi kontrol diputus tanpa jawaban
+        "truncate_rate": 0.0,    # peluang RETR hanya mengirim sebagian file
+        "truncate_mode": "abort",  # abort: transfer gagal (426); short: sisa file hilang tapi dijawab 226
+        "truncate_fraction": 0.5,
+        "login_fail_rate": 0.0,  # peluang PASS dijawab 530
+        "refuse_rate": 0.0,      # peluang koneksi baru ditolak dengan 421
+    }
+
+    def __init__(self, seed=None):
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self.injected = {}
+        self.reset()
+
+    def update(self, **faults):
+        for name, value in faults.items():
+            if name not in self.FIELDS:
+                raise ValueError(f"Gangguan tidak dikenal: {name}")
+            setattr(self, name, value)
+
+    # Matikan semua gangguan; RETR yang sedang ditahan langsung dilepas
+    def reset(self):
+        self.update(**self.FIELDS)
+        self._wake.set()
+        self._wake = threading.Event()
+
+    def describe(self):
+        active = {name: getattr(self, name) for name, default in self.FIELDS.items() if getattr(self, name) != default}
+        return ", ".join(f"{name}={value}" for name, value in active.items()) or "tanpa gangguan"
+
+    def hit(self, name, rate):
+        with self._lock:
+            if rate <= 0 or self._rng.random() >= rate:
+                return False
+            self.injected[name] = self.injected.get(name, 0) + 1
+            return True
+
+    def delay(self, name, seconds):
+        if seconds <= 0:
+            return
+        with self._lock:
+            self.injected[name] = self.injected.get(name, 0) + 1
+        self._wake.wait(seconds)
+
+
+# Producer pengganti FileProducer: mengirim sebagian isi file lalu berhenti
+class TruncatedProducer:
+    buffer_size = 65536
+
+    def __init__(self, data, abort):
+        self.data = data
+        self.abort = abort
+
+    def more(self):
+        if self.data:
+            chunk, self.data = self.data[:self.buffer_size], self.data[self.buffer_size:]
+            return chunk
+        if self.abort:
+            raise SimulatedReset(errno.ECONNRESET, "koneksi direset (simulasi)")
+        return b""
+
+
+class SimulatedReset(ConnectionResetError):
+    pass
+
+
+# Channel data yang menjawab "426 ...; transfer aborted" untuk reset simulasi, seperti saat
+# koneksi ke storage putus; error lain ditangani seperti biasa oleh pyftpdlib
+class ResettingDtpHandler(DTPHandler):
+    def handle_error(self):
+        if not isinstance(sys.exc_info()[1], SimulatedReset):
+            return super().handle_error()
+        self.close()
+        self.cmd_channel.respond("426 Connection reset (simulasi); transfer aborted.")
+
+
+class FaultyFtpHandler(CountingFtpHandler):
+    plan = FaultPlan()
+    dtp_handler = ResettingDtpHandler
+    open_connections = 0
+
+    def on_connect(self):
+        super().on_connect()
+        with CountingFtpHandler.lock:
+            FaultyFtpHandler.open_connections += 1
+
+    def on_disconnect(self):
+        with CountingFtpHandler.lock:
+            FaultyFtpHandler.open_connections -= 1
+
+    # Koneksi yang ditolak tetap didaftarkan ke ioloop; klien menutupnya setelah menerima 421
+    def handle(self):
+        self.refused = self.plan.hit("refuse", self.plan.refuse_rate)
+        if self.refused:
+            self.on_connect()
+            self.respond("421 Too many connections (simulasi).")
+            return
+        super().handle()
+
+    def pre_process_command(self, line, cmd, arg):
+        plan = self.plan
+        if self.refused:
+            self.close()
+            return
+        plan.delay("latency", plan.latency)
+        if cmd not in LOGIN_COMMANDS and plan.hit("drop", plan.drop_rate):
+            self.close()
+            return
+        if cmd == "PASS" and plan.hit("login_fail", plan.login_fail_rate):
+            self.respond("530 Authentication failed (simulasi).")
+            return
+        if cmd == "RETR":
+            plan.delay("stall", plan.stall)
+        super().pre_process_command(line, cmd, arg)
+
+    def ftp_RETR(self, file):
+        plan = self.plan
+        if not plan.hit("truncate", plan.truncate_rate):
+            return super().ftp_RETR(file)
+        rest_pos, self._restart_position = self._restart_position, 0
+        try:
+            with self.run_as_current_user(self.fs.open, file, "rb") as f:
+                f.seek(rest_pos)
+                data = f.read()
+        except OSError as err:
+            self.respond(f"550 {err.strerror}.")
+            return None
+        keep = int(len(data) * plan.truncate_fraction)
+        self.push_dtp_data(TruncatedProducer(data[:keep], plan.truncate_mode == "abort"), isproducer=True, cmd="RETR")
+        return file
+
+
+def start_faulty_ftp_server(root, port, plan):
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(FTP_USER, FTP_PASSWORD, root, perm="elr")
+    handler = FaultyFtpHandler
+    handler.authorizer = authorizer
+    handler.plan = plan
+    server = ThreadedFTPServer(("127.0.0.1", port), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"handle_exit": False}, daemon=True)
+    thread.start()
+    return server
+
+
+class Scenario:
+    def __init__(self, name, description, faults, env=None):
+        self.name = name
+        self.description = description
+        self.faults = faults
+        self.env = env or {}
+
+
+SCENARIOS = [
+    Scenario("lambat", "Server jauh: 1,5 detik per perintah FTP", {"latency": 1.5}),
+    Scenario("macet", "RETR tidak pernah dijawab (lebih lama dari FTP_TIMEOUT)", {"stall": 120}),
+    Scenario("putus", "Separuh perintah memutus koneksi kontrol", {"drop_rate": 0.5}),
+    Scenario("terpotong", "Transfer putus di tengah file (426)", {"truncate_rate": 1.0, "truncate_mode": "abort"}),
+    Scenario("terpotong_diam", "Separuh file hilang tetapi server menjawab 226", {"truncate_rate": 1.0, "truncate_mode": "short"}),
+    Scenario("login_gagal", "Semua koneksi putus dan login baru ditolak", {"drop_rate": 1.0, "login_fail_rate": 1.0}),
+    Scenario("penuh", "Koneksi baru ditolak dengan 421", {"drop_rate": 1.0, "refuse_rate": 1.0}),
+]
+
+
+# Sesi simulasi yang mencatat kapan aplikasi pertama kali bereaksi (spinner) dan apa hasil tiap panel
+class FaultSession(SimulatedSession):
+    def __init__(self, index, base_url, dates, rng, timeout):
+        super().__init__(index, base_url, dates, Stats(), rng, 0)
+        self.timeout = timeout
+
+    def panel_ok(self, name):
+        return 'src="' in self.values.get(name, {}).get("html", "")
+
+    async def view(self):
+        self.values.clear()
+        if self.rng.random() < 0.5:
+            self.area = self.rng.choice([area for area in AREAS if area != self.area])
+            data = {"area": self.area}
+        else:
+            self.date = self.rng.choice([day for day in self.dates if day != self.date])
+            data = {"select_date": self.date.strftime("%Y-%m-%d")}
+        start = time.perf_counter()
+        reacted = [None]
+
+        def done(message):
+            if reacted[0] is None and ("custom" in message or "values" in message):
+                reacted[0] = time.perf_counter() - start
+            return self.has_images()
+
+        await self.send_input(data)
+        try:
+            await self.wait_for(done, timeout=self.timeout)
+        except (TimeoutError, asyncio.TimeoutError):
+            return {"respond": reacted[0], "complete": None, "ok": False, "hung": True}
+        ok = all(self.panel_ok(name) for name in ("peta_content", "tabel_content"))
+        return {"respond": reacted[0], "complete": time.perf_counter() - start, "ok": ok, "hung": False}
+
+
+def http_probe(url):
+    start = time.perf_counter()
+    try:
+        urllib.request.urlopen(url, timeout=10).read()
+        return time.perf_counter() - start
+    except (urllib.error.URLError, OSError):
+        return None
+
+
+def process_counts(pid):
+    try:
+        fds = len(os.listdir(f"/proc/{pid}/fd"))
+        with open(f"/proc/{pid}/status") as f:
+            threads = next(int(line.split()[1]) for line in f if line.startswith("Threads:"))
+        return {"fds": fds, "threads": threads}
+    except (OSError, StopIteration):
+        return {"fds": None, "threads": None}
+
+
+# File di cache yang isinya berbeda dengan file asli di FTP (transfer terpotong yang lolos)
+def cache_damage(cache_dir, source_dir):
+    partial, corrupt = [], []
+    if not os.path.isdir(cache_dir):
+        return partial, corrupt
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".part"):
+            partial.append(entry.name)
+        elif entry.name.endswith(".png"):
+            original = os.path.join(source_dir, entry.name)
+            if os.path.exists(original) and os.path.getsize(original) != entry.stat().st_size:
+                corrupt.append(entry.name)
+    return partial, corrupt
+
+
+def percentile(values, p):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000)
+
+
+async def run_scenario(scenario, args, plan, dates, ftp_root, workdir, ftp_port):
+    cache_dir = os.path.join(workdir, scenario.name, "cache")
+    env = dict(os.environ)
+    env.update({
+        "FTP_URL": "127.0.0.1", "FTP_PORT": str(ftp_port), "FTP_USERNAME": FTP_USER, "FTP_PASSWORD": FTP_PASSWORD,
+        "FTP_PASSIVE": "1", "FTP_TIMEOUT": str(args.ftp_timeout), "DPI_SOURCE": "ftp",
+        "DPI_CACHE_DIR": cache_dir, "DPI_COUNTER_DB": os.path.join(workdir, scenario.name, "counts.sqlite3"),
+        "DPI_PREFETCH": "0", "DPI_LOG_LEVEL": "WARNING", "DPI_LOG_LIBRARY_LEVEL": "WARNING",
+    })
+    env.update(scenario.env)
+    for item in args.env:
+        name, _, value = item.partition("=")
+        env[name] = value
+    os.makedirs(os.path.join(workdir, scenario.name), exist_ok=True)
+    plan.reset()
+    plan.injected.clear()
+    app_port = free_port()
+    app = start_app(app_port, env, os.path.join(workdir, scenario.name))
+    base_url = f"http://127.0.0.1:{app_port}"
+    rng = random.Random(args.seed)
+    sessions = [FaultSession(i, base_url, dates, random.Random(rng.random()), args.view_timeout) for i in range(args.sessions)]
+    try:
+        for session in sessions:
+            await session.connect()
+        await asyncio.sleep(1)
+        before = process_counts(app.pid)
+        before_rss = rss_bytes(app.pid)
+
+        # Fase gangguan: setiap sesi terus berpindah tampilan, probe HTTP mengukur event loop
+        plan.update(**scenario.faults)
+        fault_views, probes = [], []
+        stop_at = time.monotonic() + args.fault_duration
+
+        async def keep_viewing(session):
+            while time.monotonic() < stop_at:
+                try:
+                    fault_views.append(await session.view())
+                except websockets.ConnectionClosed:
+                    fault_views.append({"respond": None, "complete": None, "ok": False, "hung": True})
+                    return
+
+        async def keep_probing():
+            while time.monotonic() < stop_at:
+                probes.append(await asyncio.to_thread(http_probe, f"{base_url}/cache"))
+                await asyncio.sleep(0.5)
+
+        await asyncio.gather(keep_probing(), *(keep_viewing(session) for session in sessions))
+
+        # Fase pemulihan: gangguan dimatikan, ukur kapan tiap sesi kembali mendapat gambar lengkap
+        plan.reset()
+        cleared = time.monotonic()
+
+        async def recover(session):
+            while time.monotonic() - cleared < args.recovery_timeout:
+                try:
+                    result = await session.view()
+                except websockets.ConnectionClosed:
+                    return None
+                if result["ok"]:
+                    return time.monotonic() - cleared
+                await asyncio.sleep(0.5)
+            return None
+
+        recovery = await asyncio.gather(*(recover(session) for session in sessions))
+
+        # Beri waktu thread unduhan yang tersisa untuk selesai sebelum menghitung kebocoran
+        await asyncio.sleep(args.settle)
+        after = process_counts(app.pid)
+        after_rss = rss_bytes(app.pid)
+        inflight = scrape_metric(app_port, "dpi_inflight_fetches")
+        ftp_open = FaultyFtpHandler.open_connections
+    finally:
+        for session in sessions:
+            await session.close()
+        app.terminate()
+        try:
+            app.wait(10)
+        except subprocess.TimeoutExpired:
+            app.kill()
+    await asyncio.sleep(1)
+    partial, corrupt = cache_damage(cache_dir, os.path.join(ftp_root, "your_data"))
+
+    def delta(name):
+        if before[name] is None or after[name] is None:
+            return None
+        return after[name] - before[name]
+
+    return {
+        "scenario": scenario.name,
+        "description": scenario.description,
+        "faults": scenario.faults,
+        "injected": dict(plan.injected),
+        "views": len(fault_views),
+        "views_ok": sum(1 for v in fault_views if v["ok"]),
+        "views_hung": sum(1 for v in fault_views if v["hung"]),
+        "respond_p95_ms": percentile([v["respond"] for v in fault_views], 95),
+        "complete_p50_ms": percentile([v["complete"] for v in fault_views], 50),
+        "complete_p95_ms": percentile([v["complete"] for v in fault_views], 95),
+        "http_probe_p95_ms": percentile(probes, 95),
+        "http_probe_failed": sum(1 for p in probes if p is None),
+        "recovery_s": [round(r, 1) if r is not None else None for r in recovery],
+        "sessions_not_recovered": sum(1 for r in recovery if r is None),
+        "leaks": {
+            "partial_files": partial,
+            "corrupt_cached_files": corrupt,
+            "fds": delta("fds"),
+            "threads": delta("threads"),
+            "rss_mb": round((after_rss - before_rss) / 2**20, 1) if before_rss and after_rss else None,
+            "inflight_fetches": inflight,
+            "ftp_connections_open": ftp_open,
+        },
+    }
+
+
+def print_result(result):
+    print(f"\n== {result['scenario']}: {result['description']}")
+    print(f"   gangguan yang terjadi: {result['injected'] or '-'}")
+    print(f"   tampilan selama gangguan: {result['views']} (lengkap {result['views_ok']}, macet {result['views_hung']})")
+    print(f"   spinner p95: {result['respond_p95_ms']} ms, panel selesai p50/p95: {result['complete_p50_ms']}/{result['complete_p95_ms']} ms")
+    print(f"   probe HTTP p95: {result['http_probe_p95_ms']} ms, gagal: {result['http_probe_failed']}")
+    recovered = [r for r in result["recovery_s"] if r is not None]
+    print(f"   waktu pulih: maks {max(recovered) if recovered else '-'} detik, sesi belum pulih: {result['sessions_not_recovered']}")
+    leaks = result["leaks"]
+    print(
+        f"   kebocoran: .part tersisa {len(leaks['partial_files'])}, file rusak di cache {len(leaks['corrupt_cached_files'])}, "
+        f"fd {leaks['fds']:+}, thread {leaks['threads']:+}, RSS {leaks['rss_mb']} MB, "
+        f"unduhan menggantung {leaks['inflight_fetches']}, koneksi FTP terbuka {leaks['ftp_connections_open']}"
+        if leaks["fds"] is not None else f"   kebocoran: {leaks}"
+    )
+
+
+def run(args):
+    names = {scenario.name: scenario for scenario in SCENARIOS}
+    unknown = [name for name in args.scenarios if name not in names]
+    if unknown:
+        sys.exit(f"Skenario tidak dikenal: {', '.join(unknown)}. Pilihan: {', '.join(names)}")
+    selected = [names[name] for name in args.scenarios] or SCENARIOS
+
+    workdir = tempfile.mkdtemp(prefix="dpi-faults-")
+    ftp_root = os.path.join(workdir, "ftp")
+    today = date.today()
+    dates = [today - timedelta(days=offset) for offset in reversed(range(args.days))]
+    seed_files(os.path.join(ftp_root, "your_data"), AREAS, dates, {"peta": args.peta_kb, "tabel": args.tabel_kb})
+    plan = FaultPlan(args.seed)
+    ftp_port = free_port()
+    server = start_faulty_ftp_server(ftp_root, ftp_port, plan)
+    results = []
+    try:
+        for scenario in selected:
+            print(f"Menjalankan skenario {scenario.name} ({scenario.description})...", flush=True)
+            result = asyncio.run(run_scenario(scenario, args, plan, dates, ftp_root, workdir, ftp_port))
+            print_result(result)
+            results.append(result)
+    finally:
+        plan.reset()
+        server.close_all()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"ftp_timeout": args.ftp_timeout, "sessions": args.sessions, "results": results}, f, indent=2)
+        print(f"Hasil disimpan ke {args.json}")
+
+
+# Jalankan simulator saja, misalnya untuk mencoba aplikasi secara manual terhadap FTP yang bermasalah
+def serve(args):
+    plan = FaultPlan(args.seed)
+    plan.update(
+        latency=args.latency, stall=args.stall, drop_rate=args.drop_rate, truncate_rate=args.truncate_rate,
+        truncate_mode=args.truncate_mode, login_fail_rate=args.login_fail_rate, refuse_rate=args.refuse_rate,
+    )
+    root = os.path.abspath(args.root)
+    if not os.path.isdir(os.path.join(root, "your_data")):
+        dates = [date.today() - timedelta(days=offset) for offset in range(args.days)]
+        count = seed_files(os.path.join(root, "your_data"), AREAS, dates, {"peta": args.peta_kb, "tabel": args.tabel_kb})
+        print(f"{count} file sintetis dibuat di {root}/your_data")
+    server = start_faulty_ftp_server(root, args.port, plan)
+    print(f"FTP simulasi di 127.0.0.1:{args.port} (user {FTP_USER}/{FTP_PASSWORD}), {plan.describe()}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"Gangguan yang terjadi: {plan.injected or '-'}, koneksi terbuka: {FaultyFtpHandler.open_connections}", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        plan.reset()
+        server.close_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulator FTP dengan injeksi gangguan dan runner skenario untuk final_app.py")
+    parser.add_argument("--seed", type=int, default=1, help="seed acak agar gangguan dapat diulang")
+    parser.add_argument("--days", type=int, default=14, help="jumlah tanggal (sampai hari ini) yang tersedia di FTP")
+    parser.add_argument("--peta-kb", type=int, default=600, help="ukuran file peta sintetis (KB)")
+    parser.add_argument("--tabel-kb", type=int, default=200, help="ukuran file tabel sintetis (KB)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="jalankan skenario gangguan terhadap aplikasi")
+    run_parser.add_argument("scenarios", nargs="*", help=f"skenario ({', '.join(s.name for s in SCENARIOS)}); default semua")
+    run_parser.add_argument("--sessions", type=int, default=5, help="jumlah sesi websocket bersamaan")
+    run_parser.add_argument("--fault-duration", type=float, default=20, help="lama gangguan aktif (detik)")
+    run_parser.add_argument("--recovery-timeout", type=float, default=90, help="batas waktu menunggu sesi pulih (detik)")
+    run_parser.add_argument("--view-timeout", type=float, default=90, help="batas waktu satu tampilan sebelum dianggap macet (detik)")
+    run_parser.add_argument("--settle", type=float, default=3, help="jeda sebelum menghitung kebocoran (detik)")
+    run_parser.add_argument("--ftp-timeout", type=float, default=5, help="FTP_TIMEOUT untuk aplikasi selama pengujian (detik)")
+    run_parser.add_argument("--env", action="append", default=[], metavar="NAMA=NILAI", help="environment tambahan untuk aplikasi (bisa diulang)")
+    run_parser.add_argument("--json", help="simpan hasil ke file JSON")
+    run_parser.add_argument("--keep", action="store_true", help="jangan hapus direktori kerja sementara")
+
+    serve_parser = commands.add_parser("serve", help="jalankan simulator FTP saja")
+    serve_parser.add_argument("--root", default="ftp_sim", help="direktori root FTP (berisi your_data/)")
+    serve_parser.add_argument("--port", type=int, default=2121)
+    serve_parser.add_argument("--latency", type=float, default=0.0)
+    serve_parser.add_argument("--stall", type=float, default=0.0)
+    serve_parser.add_argument("--drop-rate", type=float, default=0.0)
+    serve_parser.add_argument("--truncate-rate", type=float, default=0.0)
+    serve_parser.add_argument("--truncate-mode", choices=["abort", "short"], default="abort")
+    serve_parser.add_argument("--login-fail-rate", type=float, default=0.0)
+    serve_parser.add_argument("--refuse-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    # Logging dikonfigurasi lebih dulu agar pyftpdlib tidak mencetak setiap perintah FTP
+    # maupun peringatan untuk transfer yang sengaja digagalkan
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("pyftpdlib").setLevel(logging.ERROR)
+    if args.command == "run":
+        run(args)
+    else:
+        serve(args)
+
+
+if __name__ == "__main__":
+    main()
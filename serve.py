@@ -0,0 +1,127 @@
+# Launcher mode multi-worker untuk final_app.py.
+#
+# Menjalankan N proses uvicorn `final_app:app`, masing-masing di port sendiri (PORT, PORT+1, ...).
+# Semua worker berbagi folder cache (DPI_CACHE_DIR), indeks ketersediaan, dan database
+# penghitung unduhan (DPI_COUNTER_DB); unduhan FTP untuk file yang sama dikoordinasikan lewat
+# kunci file di folder cache sehingga hanya satu worker yang mengambilnya.
+#
+# Sesi Shiny disimpan di memori worker yang membukanya: websocket dan request milik sesi itu
+# (tombol unduh, "Unduh Massal") harus selalu sampai ke worker yang sama. Karena itu worker
+# tidak berbagi satu port (uvicorn --workers membagi koneksi secara acak), tetapi dipasang di
+# belakang reverse proxy dengan sticky session. Contoh konfigurasi nginx dicetak saat mulai
+# (atau dengan --nginx).
+#
+#   python serve.py --workers 4 --port 8000
+#   python serve.py --workers 4 --port 8000 --nginx > /etc/nginx/conf.d/dpi.conf
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+NGINX_TEMPLATE = """\
+# Sticky session: klien yang sama selalu ke worker yang sama (ip_hash)
+upstream dpi_workers {{
+    ip_hash;
+{servers}
+}}
+
+server {{
+    listen 80;
+
+    location / {{
+        proxy_pass http://dpi_workers;
+        proxy_http_version 1.1;
+        proxy_set_header Upgrade $http_upgrade;
+        proxy_set_header Connection "upgrade";
+        proxy_set_header Host $host;
+        proxy_read_timeout 1h;
+        # Unduhan dan ekspor ZIP di-stream, jangan ditampung di proxy
+        proxy_buffering off;
+    }}
+}}
+"""
+
+
+def nginx_config(host, ports):
+    servers = "\n".join(f"    server {host}:{port};" for port in ports)
+    return NGINX_TEMPLATE.format(servers=servers)
+
+
+# DPI_WORKER_ID dibaca final_app saat diimpor: field "worker" di log dan label worker di metrik
+def run_worker(host, port, worker_id):
+    os.environ["DPI_WORKER_ID"] = str(worker_id)
+    import uvicorn
+    # log_config=None: log uvicorn ikut lewat handler antrean dan format yang sama
+    uvicorn.run("final_app:app", host=host, port=port, log_config=None)
+
+
+def warn_unshared():
+    if os.getenv("DPI_COUNTER_BACKEND", "sqlite") == "memory":
+        print("Peringatan: DPI_COUNTER_BACKEND=memory tidak dibagi antar worker, jumlah unduhan akan berbeda per worker", file=sys.stderr)
+    try:
+        import fcntl  # noqa: F401
+    except ImportError:
+        print("Peringatan: fcntl tidak tersedia, unduhan FTP tidak dikoordinasikan antar worker", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Jalankan final_app.py dengan beberapa worker di port berurutan")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("DPI_WORKERS", str(os.cpu_count() or 1))), help="jumlah worker (default: jumlah core)")
+    parser.add_argument("--host", default=os.getenv("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")), help="port worker pertama; worker berikutnya di port sesudahnya")
+    parser.add_argument("--restart-delay", type=float, default=2, help="jeda (detik) sebelum worker yang berhenti dijalankan ulang")
+    parser.add_argument("--nginx", action="store_true", help="cetak contoh konfigurasi nginx lalu keluar")
+    args = parser.parse_args()
+
+    ports = [args.port + i for i in range(args.workers)]
+    proxy_host = "127.0.0.1" if args.host in ("0.0.0.0", "::") else args.host
+    if args.nginx:
+        print(nginx_config(proxy_host, ports), end="")
+        return
+    warn_unshared()
+
+    # Folder kerja = folder aplikasi, agar worker bisa mengimpor final_app
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    context = multiprocessing.get_context("spawn")
+    workers = {}
+    stopping = False
+
+    def start(worker_id):
+        process = context.Process(target=run_worker, args=(args.host, ports[worker_id], worker_id), name=f"dpi-worker-{worker_id}")
+        process.start()
+        workers[worker_id] = process
+        print(f"Worker {worker_id} (pid {process.pid}) di http://{args.host}:{ports[worker_id]}", file=sys.stderr)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for worker_id in range(args.workers):
+        start(worker_id)
+    print("Pasang worker di belakang reverse proxy dengan sticky session, misalnya nginx:\n", file=sys.stderr)
+    print(nginx_config(proxy_host, ports), file=sys.stderr)
+
+    while not stopping:
+        time.sleep(1)
+        for worker_id, process in list(workers.items()):
+            if process.is_alive() or stopping:
+                continue
+            print(f"Worker {worker_id} berhenti (exit {process.exitcode}), dijalankan ulang dalam {args.restart_delay:g} detik", file=sys.stderr)
+            time.sleep(args.restart_delay)
+            start(worker_id)
+
+    for process in workers.values():
+        if process.is_alive():
+            process.terminate()
+    for process in workers.values():
+        process.join(timeout=10)
+        if process.is_alive():
+            process.kill()
+
+
+if __name__ == "__main__":
+    main()